@@ -6,15 +6,34 @@
 # ║              Analyse & Intelligence Marché — Streamlit                 ║
 # ╚══════════════════════════════════════════════════════════════════════════╝
 
+import hashlib
 import io
+import json
+import os
+import pickle
 import re
+import shutil
+import sqlite3
+import threading
+import time
 import unicodedata
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import plotly.express as px
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Les frames de référence sont partagés entre sessions sans copie (§6 bis) :
+# Copy-on-Write garantit qu'aucune modification d'un frame dérivé ne remonte
+# vers le frame partagé (toujours actif à partir de pandas 3).
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # ══════════════════════════════════════════════════════════════════════════════
 # 0.  CONFIG PAGE
@@ -172,17 +191,77 @@ ASMR_COL = "Valeur de l'ASMR"
 # 3.  UTILITAIRES GÉNÉRAUX
 # ══════════════════════════════════════════════════════════════════════════════
 
+def clean_column_name(col: str) -> str:
+    """Normalise un nom de colonne (apostrophes, espaces insécables, tirets…)."""
+    for ch in ['\u2019', '\u2018', '\u02bc', '\u0060', '\u00b4']:
+        col = col.replace(ch, "'")
+    col = col.replace('\u00a0', ' ').replace('\u2013', '-').replace('\u2014', '-')
+    return unicodedata.normalize('NFKC', col).strip()
+
+
 def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Normalise les noms de colonnes (apostrophes, espaces insécables, tirets…)."""
-    def clean(col: str) -> str:
-        for ch in ['\u2019', '\u2018', '\u02bc', '\u0060', '\u00b4']:
-            col = col.replace(ch, "'")
-        col = col.replace('\u00a0', ' ').replace('\u2013', '-').replace('\u2014', '-')
-        return unicodedata.normalize('NFKC', col).strip()
-    df.columns = [clean(c) for c in df.columns]
+    df.columns = [clean_column_name(c) for c in df.columns]
     return df
 
 
+def compact_frame(df: pd.DataFrame, categorical: list | tuple = (),
+                  max_ratio: float = 0.5) -> pd.DataFrame:
+    """
+    Représentation mémoire compacte d'un DataFrame (mêmes valeurs) :
+      - colonnes entièrement vides conservées (les pages les indexent
+        directement) : catégorielle ou float32 vide, quasi sans coût
+      - texte répétitif (colonnes `categorical`, ou ≤ max_ratio de valeurs
+        distinctes) encodé en catégorielle
+      - entiers réduits au plus petit type, flottants en float32 si sans perte
+    """
+    out = {}
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            pass
+        elif pd.api.types.is_integer_dtype(s):
+            s = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s):
+            s32 = s.astype("float32")
+            if s32.astype("float64").equals(s.astype("float64")):
+                s = s32
+        elif pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            if col in categorical or s.nunique() <= max_ratio * len(s):
+                s = s.astype(object).astype("category")
+        out[col] = s
+    return pd.DataFrame(out, index=df.index)
+
+
+def _arrow_string_dtype():
+    """Chaînes adossées à Arrow avec sémantique NaN (dtype "str" de pandas 3), si disponible."""
+    try:
+        return pd.StringDtype("pyarrow", na_value=np.nan)      # pandas ≥ 2.3
+    except TypeError:
+        try:
+            return pd.StringDtype("pyarrow_numpy")              # pandas 2.1 – 2.2
+        except (TypeError, ValueError, ImportError):
+            return None
+    except ImportError:
+        return None
+
+
+def to_arrow_strings(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convertit les colonnes texte encore en `object` en chaînes Arrow : buffers
+    contigus et immuables, sans un objet Python par cellule. Les colonnes
+    mixtes (texte + nombres) sont laissées telles quelles.
+    """
+    dtype = _arrow_string_dtype()
+    if dtype is None:
+        return df
+    text_cols = [
+        c for c in df.columns
+        if df[c].dtype == "object" and pd.api.types.infer_dtype(df[c], skipna=True) == "string"
+    ]
+    return df.astype({c: dtype for c in text_cols}) if text_cols else df
+
+
 def clean_illegal_characters(dataframe: pd.DataFrame) -> pd.DataFrame:
     """Supprime TOUS les caractères illégaux pour openpyxl."""
     illegal = re.compile(
@@ -193,7 +272,10 @@ def clean_illegal_characters(dataframe: pd.DataFrame) -> pd.DataFrame:
     )
     df_c = dataframe.copy()
     for col in df_c.columns:
-        if df_c[col].dtype == "object":
+        s = df_c[col]
+        # object (pandas < 3), chaînes Arrow (dtype "str", cf. to_arrow_strings) et catégorielles
+        if (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)
+                or isinstance(s.dtype, pd.CategoricalDtype)):
             df_c[col] = (
                 df_c[col]
                 .astype(str)
@@ -207,7 +289,7 @@ def export_excel(dataframe: pd.DataFrame, sheet_name: str = "Export") -> bytes:
     df_clean = clean_illegal_characters(dataframe)
     # Forcer l'encodage utf-8 pour éliminer les caractères résiduels
     for col in df_clean.columns:
-        if df_clean[col].dtype == "object":
+        if pd.api.types.is_object_dtype(df_clean[col]) or pd.api.types.is_string_dtype(df_clean[col]):
             df_clean[col] = (
                 df_clean[col]
                 .astype(str)
@@ -249,21 +331,29 @@ def section_header(title: str):
     st.markdown(f'<div class="section-header">{title}</div>', unsafe_allow_html=True)
 
 
-def plot_pie(df_lab: pd.DataFrame, col_valeur: str, title: str,
-             label_map=None, color_map=None, height: int = 380):
+def plot_pie(df_lab: pd.DataFrame | None, col_valeur: str, title: str,
+             label_map=None, color_map=None, height: int = 380,
+             counts: pd.Series | None = None):
     """
     Camembert avec labels enrichis et couleurs sémantiques.
     - Pourcentage uniquement dans le camembert
     - Label complet dans la légende
+    `counts` (niveau → effectif, dans l'ordre de première apparition, cf.
+    rating_lookup) évite de recompter `df_lab`, qui peut alors être None.
     """
-    df_c = df_lab.copy()
-    df_c["pie_label"] = (
-        df_c[col_valeur].fillna("Non renseigné").astype(str).str.strip()
-    )
-    if label_map:
-        df_c["pie_label"] = df_c["pie_label"].apply(lambda x: label_map.get(x, x))
+    import plotly.express as px
 
-    pie_counts = df_c["pie_label"].value_counts().reset_index()
+    if counts is None:
+        counts = (
+            df_lab[col_valeur].astype(object).fillna("Non renseigné").astype(str).str.strip()
+            .value_counts(sort=False)
+        )
+    labels = counts.index.map(lambda x: label_map.get(x, x)) if label_map else counts.index
+    pie_counts = (
+        counts.groupby(labels, sort=False).sum()
+        .sort_values(ascending=False, kind="stable")
+        .reset_index()
+    )
     pie_counts.columns = ["Valeur", "count"]
 
     fig = px.pie(
@@ -288,30 +378,249 @@ def plot_pie(df_lab: pd.DataFrame, col_valeur: str, title: str,
 # 5.  CHARGEMENT & NETTOYAGE DES DONNÉES
 # ══════════════════════════════════════════════════════════════════════════════
 
-@st.cache_data(show_spinner="Chargement des données…")
-def load_csv_from_drive(file_id: str, sep: str = "\t") -> pd.DataFrame:
-    url = f"https://drive.google.com/uc?export=download&id={file_id}"
-    for encoding in ["utf-8", "utf-8-sig", "latin-1"]:
-        try:
-            df = pd.read_csv(url, sep=sep, engine="python", encoding=encoding)
-            " ".join(df.columns).encode("utf-8")
-            return normalize_columns(df)
-        except (UnicodeDecodeError, UnicodeEncodeError):
-            continue
-    df = pd.read_csv(url, sep=sep, engine="python", encoding="utf-8", errors="replace")
-    return normalize_columns(df)
-
-
 # IDs Google Drive
 ID_COMPACT   = "1y-vVibmmuKyBcMcSX6UopgP5YuVos-Xn"
 ID_BIG10     = "1TDzeC3Ug3JSN9wI1ENlGks4dwWL64jMU"
 ID_DISPO     = "1EUDSX1PJowZPQ949dzbyKLX_BTBZBe3q"
 ID_MED_DISPO = "1JGG3QOZO8C-56fog63M3R05IzV5xqh0T"
 
-df  = load_csv_from_drive(ID_COMPACT)
-df1 = load_csv_from_drive(ID_BIG10)
-df2 = load_csv_from_drive(ID_DISPO)
-df3 = load_csv_from_drive(ID_MED_DISPO)
+# ── Schéma déclaré par export ────────────────────────────────────────────────
+# Colonnes (noms normalisés) typées explicitement à la lecture :
+#   "str"   → codes et libellés lus tels quels (pas d'inférence int/float,
+#             les codes CIS / CIP13 / dossier restent comparables en texte)
+#   "float" → numériques, valeurs non convertibles → NaN
+# Les colonnes non déclarées gardent l'inférence pandas.
+DATASET_SCHEMAS = {
+    ID_COMPACT: {
+        "Code CIS": "str", "CIP13": "str", "Dénomination du médicament": "str",
+        "Titulaire(s)": "str", SMR_COL: "str", ASMR_COL: "str",
+    },
+    ID_BIG10: {
+        "Code CIS": "str", "Dénomination du médicament": "str", "Titulaire(s)": "str",
+        "Revenue_USD": "float", SMR_COL: "str", ASMR_COL: "str",
+    },
+    ID_DISPO: {
+        "Code dossier": "str", "Nom dispositif": "str",
+    },
+    ID_MED_DISPO: {
+        "Titulaire(s)": "str", "groupe_racine": "str", "type_produit": "str",
+        SMR_COL: "str", ASMR_COL: "str",
+    },
+}
+
+# ── Sources & snapshots locaux ───────────────────────────────────────────────
+# Les exports sont lus depuis Google Drive, ou depuis un répertoire local
+# (DEFIS_SOURCE_DIR, un fichier par ID Drive) pour les tests et le hors-ligne,
+# ou depuis une URL de substitution (DEFIS_SOURCE_URL, gabarit avec {file_id}).
+# Chaque export normalisé est conservé en Parquet dans SNAPSHOT_DIR, indexé par
+# ID de fichier et empreinte du contenu : un redémarrage relit le disque local
+# au lieu de re-télécharger et re-parser.
+DRIVE_URL        = os.environ.get(
+    "DEFIS_SOURCE_URL", "https://drive.google.com/uc?export=download&id={file_id}"
+)
+LOCAL_SOURCE_DIR = os.environ.get("DEFIS_SOURCE_DIR")
+SNAPSHOT_DIR     = Path(
+    os.environ.get("DEFIS_SNAPSHOT_DIR", Path(__file__).resolve().parent / ".snapshots")
+)
+# À incrémenter quand le parsing change (schéma, typage) : les anciens snapshots
+# sont alors ignorés et reconstruits.
+SNAPSHOT_FORMAT  = 3
+
+
+def fetch_source(file_id: str, validators: dict | None = None) -> tuple[bytes | None, dict]:
+    """
+    Contenu brut d'un export (répertoire local si configuré, sinon Drive).
+    Requête conditionnelle si `validators` contient un ETag / Last-Modified :
+    retourne (None, validators) quand la source répond 304 (inchangée).
+    """
+    if LOCAL_SOURCE_DIR:
+        return (Path(LOCAL_SOURCE_DIR) / file_id).read_bytes(), {}
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    request = urllib.request.Request(DRIVE_URL.format(file_id=file_id), headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=120) as resp:
+            return resp.read(), {
+                "etag":          resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, validators
+        raise
+
+
+def _snapshot_pointer(file_id: str) -> Path:
+    return SNAPSHOT_DIR / f"{file_id}.json"
+
+
+def snapshot_meta(file_id: str) -> dict | None:
+    """Pointeur JSON du snapshot courant (empreinte, validateurs HTTP…), ou None."""
+    try:
+        meta = json.loads(_snapshot_pointer(file_id).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("format") == SNAPSHOT_FORMAT else None
+
+
+def _write_pointer(file_id: str, meta: dict) -> None:
+    pointer_tmp = SNAPSHOT_DIR / f"{file_id}.json.tmp"
+    pointer_tmp.write_text(json.dumps(meta), encoding="utf-8")
+    os.replace(pointer_tmp, _snapshot_pointer(file_id))
+
+
+def read_snapshot(file_id: str) -> pd.DataFrame | None:
+    """Relit le dernier snapshot Parquet d'un export, ou None s'il est absent/illisible."""
+    meta = snapshot_meta(file_id)
+    if meta is None:
+        return None
+    try:
+        return pd.read_parquet(SNAPSHOT_DIR / meta["file"])
+    except (OSError, ValueError, KeyError, ImportError):
+        return None
+
+
+def write_snapshot(file_id: str, content_hash: str, df: pd.DataFrame,
+                   validators: dict | None = None) -> None:
+    """
+    Écrit le snapshot `<file_id>-<hash>.parquet` puis bascule le pointeur JSON.
+    Best effort : un échec d'écriture (disque, colonne non sérialisable…)
+    ne doit jamais empêcher l'application de démarrer.
+    """
+    name = f"{file_id}-{content_hash[:16]}.parquet"
+    try:
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = SNAPSHOT_DIR / f"{name}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, SNAPSHOT_DIR / name)
+        _write_pointer(file_id, {
+            "file_id":    file_id,
+            "format":     SNAPSHOT_FORMAT,
+            "sha256":     content_hash,
+            "file":       name,
+            "rows":       len(df),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            **(validators or {}),
+        })
+    except (OSError, ValueError, TypeError, ImportError):
+        return
+    # Les snapshots précédents du même fichier ne sont plus référencés
+    for old in SNAPSHOT_DIR.glob(f"{file_id}-*.parquet"):
+        if old.name != name:
+            old.unlink(missing_ok=True)
+
+
+def invalidate_snapshot(file_id: str | None = None) -> None:
+    """Supprime le snapshot d'un export (ou de tous) : le prochain chargement refera le fetch."""
+    pattern = file_id or "*"
+    for path in [*SNAPSHOT_DIR.glob(f"{pattern}.json"), *SNAPSHOT_DIR.glob(f"{pattern}-*.parquet")]:
+        path.unlink(missing_ok=True)
+
+
+def detect_encoding(raw: bytes, sample_size: int = 1 << 16) -> str:
+    """
+    Détermine l'encodage d'un export sur un échantillon de tête :
+      - BOM UTF-8          → 'utf-8-sig'
+      - échantillon UTF-8  → 'utf-8'  (un caractère coupé en fin d'échantillon est toléré)
+      - sinon              → 'latin-1'
+    """
+    if raw.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    sample = raw[:sample_size]
+    try:
+        sample.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.reason != "unexpected end of data" or len(raw) <= sample_size:
+            return "latin-1"
+    return "utf-8"
+
+
+def _read_csv_arrow(raw: bytes, sep: str, encoding: str, text_cols: list) -> pd.DataFrame:
+    """
+    Lecture pyarrow directe : les colonnes texte sont typées en chaîne AVANT
+    l'inférence (le `dtype=str` du moteur pyarrow de pandas n'est appliqué
+    qu'après coup, si bien qu'un code "00012" revenait en "12").
+    Mêmes marqueurs de valeurs manquantes que pandas.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    convert = pv.ConvertOptions(
+        column_types={c: pa.string() for c in text_cols},
+        null_values=[*pv.ConvertOptions().null_values, "None", "<NA>"],
+        strings_can_be_null=True,
+    )
+    table = pv.read_csv(
+        io.BytesIO(raw),
+        read_options=pv.ReadOptions(encoding=encoding),
+        parse_options=pv.ParseOptions(delimiter=sep),
+        convert_options=convert,
+    )
+    return table.to_pandas()
+
+
+def parse_export(raw: bytes, sep: str = "\t", schema: dict | None = None) -> pd.DataFrame:
+    """
+    Parse un export en une seule passe à partir des octets déjà téléchargés :
+    moteur pyarrow (multi-thread), repli sur le moteur C s'il refuse le fichier.
+    Colonnes normalisées puis typées selon `schema` (cf. DATASET_SCHEMAS).
+    """
+    schema   = schema or {}
+    encoding = detect_encoding(raw)
+    options  = dict(sep=sep, encoding=encoding, encoding_errors="replace")
+
+    # Les noms bruts peuvent différer des noms normalisés du schéma (apostrophes…).
+    # Les numériques sont lus en texte puis convertis : une valeur parasite
+    # ("N/A", "-") devient NaN au lieu de faire échouer toute la lecture.
+    header = pd.read_csv(io.BytesIO(raw), nrows=0, engine="c", **options).columns
+    dtype  = {c: str for c in header if clean_column_name(c) in schema}
+
+    try:
+        df = _read_csv_arrow(raw, sep, encoding, list(dtype))
+    except (ImportError, ValueError):
+        df = pd.read_csv(io.BytesIO(raw), dtype=dtype, engine="c", low_memory=False, **options)
+    df = normalize_columns(df)
+    for col, kind in schema.items():
+        if kind == "float" and col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df
+
+
+def load_csv_from_drive(file_id: str, sep: str = "\t") -> pd.DataFrame:
+    snapshot = read_snapshot(file_id)
+    if snapshot is not None:
+        return snapshot
+    raw, validators = fetch_source(file_id)
+    df = parse_export(raw, sep, DATASET_SCHEMAS.get(file_id))
+    write_snapshot(file_id, hashlib.sha256(raw).hexdigest(), df, validators)
+    return df
+
+
+def refresh_source(file_id: str, sep: str = "\t") -> bool:
+    """
+    Revalide un export auprès de sa source (ETag / Last-Modified, puis empreinte
+    du contenu) et réécrit son snapshot s'il a changé. Retourne True si changé.
+    """
+    meta = snapshot_meta(file_id) or {}
+    raw, validators = fetch_source(file_id, meta)
+    if raw is None:
+        return False
+    content_hash = hashlib.sha256(raw).hexdigest()
+    if content_hash == meta.get("sha256"):
+        if validators != {k: meta.get(k) for k in validators}:
+            try:
+                _write_pointer(file_id, {**meta, **validators})
+            except OSError:
+                pass
+        return False
+    df = parse_export(raw, sep, DATASET_SCHEMAS.get(file_id))
+    write_snapshot(file_id, content_hash, df, validators)
+    return True
+
 
 # ── Mapping laboratoires (appliqué sur df ET df1) ────────────────────────────
 MAPPING_LABO = {
@@ -338,9 +647,15 @@ MAPPING_LABO = {
     " ROCHE REGISTRATION (ALLEMAGNE)": "ROCHE",
 }
 
-df["Titulaire(s)"]  = df["Titulaire(s)"].replace(MAPPING_LABO)
-df1["Titulaire(s)"] = df1["Titulaire(s)"].replace(MAPPING_LABO)   # ← correction
-df = df.drop_duplicates(subset=["Code CIS", "CIP13"], keep="first")
+
+def prepare_compact(df: pd.DataFrame) -> pd.DataFrame:
+    df["Titulaire(s)"] = df["Titulaire(s)"].replace(MAPPING_LABO)
+    return df.drop_duplicates(subset=["Code CIS", "CIP13"], keep="first")
+
+
+def prepare_big10(df1: pd.DataFrame) -> pd.DataFrame:
+    df1["Titulaire(s)"] = df1["Titulaire(s)"].replace(MAPPING_LABO)   # ← correction
+    return df1
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -354,6 +669,8 @@ ROMAN_TO_LABEL = {
     "IV":  "IV — Mineure",
     "V":   "V — Absente",
 }
+# Forme longue CNEDiMTS : "III. Amélioration modérée"
+ASMR_LONG_FORM = re.compile(r'^(I{1,3}V?|VI{0,3}|IV|V)\.\s+')
 
 def normalize_smr(val) -> str:
     if pd.isna(val):
@@ -375,7 +692,7 @@ def normalize_asmr_asr(val, type_produit):
     if pd.isna(val) or str(val).strip() == "":
         return ("Non précisé", "Non précisé", "Non précisé")
     v = str(val).strip()
-    m = re.match(r'^(I{1,3}V?|VI{0,3}|IV|V)\.\s+', v)
+    m = ASMR_LONG_FORM.match(v)
     if m:
         roman = m.group(1)
         return (roman, ROMAN_TO_LABEL.get(roman, roman), "ASR")
@@ -388,21 +705,789 @@ def normalize_asmr_asr(val, type_produit):
     return ("Non précisé", "Non précisé", "Non précisé")
 
 
-@st.cache_data(show_spinner=False)
-def enrich_df3(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    df["_smr_norm"] = df["Valeur du SMR"].apply(normalize_smr)
-    parsed = df.apply(
-        lambda r: pd.Series(
-            normalize_asmr_asr(r["Valeur de l'ASMR"], r["type_produit"]),
-            index=["_roman", "_label_amr", "_source_amr"],
+def _stripped_text(values: pd.Series) -> pd.Series:
+    """str(val).strip() sur les valeurs renseignées, NaN ailleurs (sémantique Python)."""
+    values = values.astype(object)
+    filled = values.notna()
+    out = pd.Series(np.nan, index=values.index, dtype=object)
+    out[filled] = values[filled].astype(str).str.strip()
+    return out
+
+
+def normalize_smr_series(values: pd.Series) -> pd.Series:
+    """Version vectorisée de normalize_smr (catégorielle, ordre SMR_ORDER)."""
+    norm = _stripped_text(values).map(SMR_NORM).fillna("Non précisé")
+    return pd.Series(pd.Categorical(norm, categories=SMR_ORDER), index=values.index)
+
+
+def normalize_asmr_asr_frame(values: pd.Series, type_produit: pd.Series) -> pd.DataFrame:
+    """
+    Version vectorisée de normalize_asmr_asr : mêmes règles, évaluées dans le
+    même ordre sur toute la colonne. Retourne _roman / _label_amr / _source_amr
+    en catégorielles.
+    """
+    v        = _stripped_text(values)
+    v_txt    = v.fillna("")
+    is_med   = type_produit.astype(object).eq("medicament")
+    src_type = pd.Series(np.where(is_med, "ASMR", "ASR"), index=v.index)
+
+    long_roman = v_txt.str.extract(ASMR_LONG_FORM, expand=False)
+    is_long    = long_roman.notna()
+    is_short   = ~is_long & v_txt.isin(list(ROMAN_TO_LABEL))
+    is_comment = ~is_long & ~is_short & v_txt.str.lower().str.contains("commentaire", regex=False)
+
+    roman  = pd.Series("Non précisé", index=v.index, dtype=object)
+    label  = roman.copy()
+    source = roman.copy()
+
+    roman[is_long]  = long_roman[is_long]
+    label[is_long]  = long_roman[is_long].map(lambda r: ROMAN_TO_LABEL.get(r, r))
+    source[is_long] = "ASR"
+
+    roman[is_short]  = v_txt[is_short]
+    label[is_short]  = v_txt[is_short].map(ROMAN_TO_LABEL)
+    source[is_short] = src_type[is_short]
+
+    roman[is_comment]  = "Non chiffré"
+    label[is_comment]  = "Non chiffré"
+    source[is_comment] = src_type[is_comment]
+
+    # Chiffres romains atypiques de la forme longue ("VI.", "IIV.") conservés tels quels
+    extra = sorted(set(roman.unique()) - set(ASMR_ORDER))
+    return pd.DataFrame({
+        "_roman":      pd.Categorical(roman, categories=ASMR_ORDER + extra),
+        "_label_amr":  pd.Categorical(
+            label,
+            categories=[*ROMAN_TO_LABEL.values(), "Non chiffré", "Non précisé", *extra],
         ),
-        axis=1,
-    )
+        "_source_amr": pd.Categorical(source, categories=["ASMR", "ASR", "Non précisé"]),
+    }, index=v.index)
+
+
+def enrich_df3(df: pd.DataFrame) -> pd.DataFrame:
+    # Copie superficielle : les colonnes d'origine sont partagées avec df3,
+    # seules les colonnes normalisées sont allouées
+    df = df.copy(deep=False)
+    df["_smr_norm"] = normalize_smr_series(df["Valeur du SMR"])
+    parsed = normalize_asmr_asr_frame(df["Valeur de l'ASMR"], df["type_produit"])
     return pd.concat([df, parsed], axis=1)
 
 
-df3_enriched = enrich_df3(df3)   # variable séparée — ne pollue pas df3 global
+def group_kpis(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Indicateurs clés de tous les groupes en un seul groupby (mêmes règles que
+    compute_kpi, §7) : total, médicaments, dispositifs, % ASMR I-II.
+    """
+    asmr_col = next((c for c in df.columns if "asmr" in c.lower()), None)
+    flags = pd.DataFrame({
+        "groupe_racine": df["groupe_racine"],
+        "nb_med":        df["type_produit"] == "medicament",
+        "nb_dm":         df["type_produit"] == "dispositif_medical",
+        "taux_asmr_12":  df[asmr_col].isin(["I", "II"]) if asmr_col else False,
+    })
+    grouped = flags.groupby("groupe_racine", observed=True)
+    result  = grouped.agg(
+        total=("nb_med", "size"), nb_med=("nb_med", "sum"),
+        nb_dm=("nb_dm", "sum"), taux_asmr_12=("taux_asmr_12", "mean"),
+    )
+    result["taux_asmr_12"] = result["taux_asmr_12"] * 100
+    return result.reset_index()
+
+
+LEADERBOARD_CENTILE = " — centile"
+
+
+def group_leaderboard(df: pd.DataFrame, kpis: pd.DataFrame) -> pd.DataFrame:
+    """
+    Classement de tous les groupes : indicateurs de group_kpis, répartition
+    SMR / SR (_smr_norm) et ASMR / ASR (_roman) en % des produits du groupe,
+    et centile de chaque groupe pour chaque indicateur (100 = valeur la plus
+    élevée). Tout est calculé par groupby, sans boucle sur les groupes.
+    """
+    board = kpis.set_index("groupe_racine").rename(columns={
+        "total": "Produits", "nb_med": "Médicaments",
+        "nb_dm": "Dispositifs", "taux_asmr_12": "% ASMR I-II",
+    })
+    for col, prefix in (("_smr_norm", "% SMR"), ("_roman", "% ASMR")):
+        counts = df.groupby(["groupe_racine", col], observed=True).size().unstack(fill_value=0)
+        shares = counts.div(counts.sum(axis=1), axis=0) * 100
+        shares.columns = [f"{prefix} {level}" for level in shares.columns]
+        board = board.join(shares.astype(float)).fillna({c: 0.0 for c in shares.columns})
+    metrics = list(board.columns)
+    centiles = board[metrics].rank(pct=True) * 100
+    centiles.columns = [f"{m}{LEADERBOARD_CENTILE}" for m in metrics]
+    return board.join(centiles).rename_axis("groupe_racine").reset_index()
+
+
+def group_rating_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Effectifs groupe × type de produit × indicateur (SMR / ASMR) × niveau, en
+    un seul groupby. Niveaux tels qu'affichés par plot_pie (texte nettoyé,
+    « Non renseigné » si vide) ; `premier` = position de la première ligne,
+    pour conserver l'ordre de value_counts à effectif égal.
+    """
+    long = pd.concat(
+        [
+            pd.DataFrame({
+                "groupe_racine": df["groupe_racine"].astype(object),
+                "type_produit":  df["type_produit"].astype(object),
+                "indicateur":    col,
+                "niveau":        df[col].astype(object).fillna("Non renseigné").astype(str).str.strip(),
+                "position":      np.arange(len(df)),
+            })
+            for col in (SMR_COL, ASMR_COL)
+        ],
+        ignore_index=True,
+    )
+    cube = long.groupby(["groupe_racine", "type_produit", "indicateur", "niveau"], sort=False).agg(
+        effectif=("position", "size"), premier=("position", "min"),
+    )
+    return cube.reset_index()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 6 bis.  REGISTRE DES DATASETS (chargement à la demande)
+# ══════════════════════════════════════════════════════════════════════════════
+#
+# Rien n'est chargé à l'import : chaque page déclare ses datasets
+# (PAGE_DATASETS, §14) et ils sont chargés au premier accès, en parallèle.
+#   - DATASETS       : exports bruts (ID Drive)
+#   - DATASET_PREPARE: nettoyage appliqué juste après le chargement
+#   - DERIVED_VIEWS  : vues calculées à partir d'autres datasets
+#
+# Les frames vivent dans un store partagé par toutes les sessions du process.
+# Un thread de fond revalide les sources toutes les REFRESH_INTERVAL secondes
+# (requête conditionnelle puis empreinte du contenu) : seuls les exports
+# modifiés et les vues qui en dépendent sont reconstruits, hors du chemin des
+# sessions, puis basculés ensemble sous verrou.
+# ──────────────────────────────────────────────────────────────────────────────
+
+DATASETS = {
+    "df":  ID_COMPACT,
+    "df1": ID_BIG10,
+    "df2": ID_DISPO,
+    "df3": ID_MED_DISPO,
+}
+DATASET_PREPARE = {
+    "df":  prepare_compact,
+    "df1": prepare_big10,
+}
+DERIVED_VIEWS = {
+    # variable séparée — ne pollue pas df3
+    "df3_enriched":      (["df3"], enrich_df3),
+    # agrégats par groupe (page Laboratoire)
+    "group_kpis":        (["df3_enriched"], group_kpis),
+    "group_cube":        (["df3_enriched"], group_rating_cube),
+    "group_leaderboard": (["df3_enriched", "group_kpis"], group_leaderboard),
+}
+
+REFRESH_INTERVAL = int(os.environ.get("DEFIS_REFRESH_SECONDS", "3600"))   # 0 = désactivé
+
+# Mode mémoire compacte (DEFIS_COMPACT_MEMORY=1) : chaque dataset passe par
+# compact_frame() avant d'être installé dans le store.
+COMPACT_MEMORY      = os.environ.get("DEFIS_COMPACT_MEMORY", "0") == "1"
+CATEGORICAL_COLUMNS = ["Titulaire(s)", "groupe_racine", "type_produit", SMR_COL, ASMR_COL]
+
+
+# ── Publication Arrow partagée entre processus ──────────────────────────────
+# Avec DEFIS_SHARED_DIR, chaque dataset finalisé (vues dérivées comprises) est
+# publié en Arrow IPC non compressé, `<nom>-<version>.arrow` + pointeur JSON.
+# Les autres processus Streamlit du nœud le projettent en mémoire (mmap) au
+# lieu de re-parser et ré-enrichir : le cache de pages de l'OS n'en garde
+# qu'une copie, et un nouveau worker démarre sans rien reconstruire.
+SHARED_DIR    = os.environ.get("DEFIS_SHARED_DIR")
+# À incrémenter quand la préparation (mapping, enrich_df3…) change
+SHARED_FORMAT = 3
+
+
+def _shared_key(version) -> str | None:
+    """Empreinte courte d'une version (str ou tuple), None si incomplète."""
+    parts = version if isinstance(version, tuple) else (version,)
+    if any(p is None for p in parts):
+        return None
+    payload = json.dumps([SHARED_FORMAT, COMPACT_MEMORY, list(parts)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def read_arrow(path: Path) -> pd.DataFrame | None:
+    """Projette en mémoire un fichier Arrow IPC (mmap), None s'il est absent/illisible."""
+    try:
+        import pyarrow as pa
+        table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    except (OSError, ValueError, ImportError):
+        return None
+    # Les chaînes restent dans les buffers projetés (pas de copie en objets Python)
+    dtype  = _arrow_string_dtype()
+    mapper = {pa.string(): dtype, pa.large_string(): dtype}.get if dtype is not None else None
+    return table.to_pandas(split_blocks=True, types_mapper=mapper)
+
+
+def write_arrow(path: Path, frame: pd.DataFrame) -> None:
+    """Écrit un frame en Arrow IPC non compressé (projetable), via un fichier temporaire."""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    tmp   = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, path)
+
+
+def read_shared(name: str, version) -> pd.DataFrame | None:
+    """Projette en mémoire le dataset publié s'il correspond à `version`, sinon None."""
+    key = _shared_key(version)
+    if not SHARED_DIR or key is None:
+        return None
+    try:
+        meta = json.loads((Path(SHARED_DIR) / f"{name}.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if meta.get("key") != key or "file" not in meta:
+        return None
+    return read_arrow(Path(SHARED_DIR) / meta["file"])
+
+
+def publish_shared(name: str, version, frame: pd.DataFrame) -> None:
+    """Publie un dataset finalisé pour les autres processus (best effort)."""
+    key = _shared_key(version)
+    if not SHARED_DIR or key is None:
+        return
+    shared = Path(SHARED_DIR)
+    file   = f"{name}-{key}.arrow"
+    try:
+        shared.mkdir(parents=True, exist_ok=True)
+        if not (shared / file).exists():
+            write_arrow(shared / file, frame)
+        pointer_tmp = shared / f"{name}.json.{os.getpid()}.tmp"
+        pointer_tmp.write_text(json.dumps({
+            "name": name, "key": key, "file": file, "rows": len(frame),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        }), encoding="utf-8")
+        os.replace(pointer_tmp, shared / f"{name}.json")
+    except (OSError, ValueError, TypeError, ImportError):
+        return
+    # Versions précédentes : un worker qui les projette encore garde son mapping
+    for old in shared.glob(f"{name}-*.arrow"):
+        if old.name != file:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+
+# ── Bundle pré-construit (python DEFI6.py build, §6 ter) ─────────────────────
+# Avec DEFIS_BUNDLE_DIR, l'application ne lit plus les sources : elle projette
+# les datasets du dernier bundle publié (pointeur current.json) et le thread de
+# revalidation bascule sur le bundle suivant dès qu'un build le publie.
+BUNDLE_DIR    = os.environ.get("DEFIS_BUNDLE_DIR")
+BUNDLE_FORMAT = 1
+
+
+def _as_version(value):
+    """Version relue du JSON : les listes (vues dérivées) redeviennent des tuples."""
+    return tuple(_as_version(v) for v in value) if isinstance(value, list) else value
+
+
+def bundle_manifest() -> dict | None:
+    """Manifeste du bundle courant de BUNDLE_DIR, ou None."""
+    if not BUNDLE_DIR:
+        return None
+    try:
+        current  = json.loads((Path(BUNDLE_DIR) / "current.json").read_text(encoding="utf-8"))
+        manifest = json.loads(
+            (Path(BUNDLE_DIR) / current["build_id"] / "manifest.json").read_text(encoding="utf-8")
+        )
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest if manifest.get("format") == BUNDLE_FORMAT else None
+
+
+def read_bundle(name: str) -> tuple[pd.DataFrame, object] | None:
+    """(frame, version) d'un dataset du bundle courant, ou None."""
+    manifest = bundle_manifest()
+    entry    = (manifest or {}).get("datasets", {}).get(name)
+    if entry is None:
+        return None
+    frame = read_arrow(Path(BUNDLE_DIR) / manifest["build_id"] / entry["file"])
+    return (frame, _as_version(entry["version"])) if frame is not None else None
+
+
+@st.cache_resource
+def data_store() -> dict:
+    """
+    État partagé par toutes les sessions du process :
+      frames   : nom → DataFrame courant (jamais modifié sur place, seulement remplacé)
+      versions : nom → empreinte de la source, ou tuple des versions d'entrée d'une vue
+      indexes  : clé → (version, index) — cf. search_index(), typeahead_index()
+    """
+    return new_store()
+
+
+def new_store() -> dict:
+    return {"lock": threading.Lock(), "loading": {}, "frames": {}, "versions": {}, "memory": {},
+            "indexes": {}}
+
+
+def _name_lock(store: dict, name: str) -> threading.Lock:
+    with store["lock"]:
+        return store["loading"].setdefault(name, threading.Lock())
+
+
+def _install(store: dict, updates: dict) -> None:
+    """Bascule atomique d'un ou plusieurs datasets : {nom: (frame, version)}."""
+    with store["lock"]:
+        for name, (frame, version) in updates.items():
+            store["frames"][name]   = frame
+            store["versions"][name] = version
+
+
+def _finalize(frame: pd.DataFrame) -> pd.DataFrame:
+    frame = to_arrow_strings(frame)
+    return compact_frame(frame, CATEGORICAL_COLUMNS) if COMPACT_MEMORY else frame
+
+
+def dataset_version(name: str, store: dict | None = None) -> str:
+    """Version courante d'un dataset (clé de cache des résultats qui en dérivent)."""
+    store = store if store is not None else data_store()
+    return str(store["versions"].get(name))
+
+
+def _build_raw(name: str) -> tuple[pd.DataFrame, str | None]:
+    bundled = read_bundle(name)
+    if bundled is not None:
+        return bundled
+    file_id = DATASETS[name]
+    version = (snapshot_meta(file_id) or {}).get("sha256")
+    shared  = read_shared(name, version)
+    if shared is not None:
+        return shared, version
+    frame   = load_csv_from_drive(file_id)
+    prepare = DATASET_PREPARE.get(name)
+    frame   = _finalize(prepare(frame) if prepare else frame)
+    version = (snapshot_meta(file_id) or {}).get("sha256")
+    publish_shared(name, version, frame)
+    return frame, version
+
+
+def _build_view(name: str, args: list, version: tuple) -> pd.DataFrame:
+    bundled = read_bundle(name)
+    if bundled is not None and bundled[1] == version:
+        return bundled[0]
+    shared = read_shared(name, version)
+    if shared is not None:
+        return shared
+    frame = _finalize(DERIVED_VIEWS[name][1](*args))
+    publish_shared(name, version, frame)
+    return frame
+
+
+def _input_versions(store: dict, name: str) -> tuple:
+    return tuple(store["versions"].get(i) for i in DERIVED_VIEWS[name][0])
+
+
+def load_dataset(name: str, store: dict | None = None) -> pd.DataFrame:
+    """Dataset prêt à l'emploi (brut nettoyé ou vue dérivée), chargé une fois par process."""
+    store = store if store is not None else data_store()
+    if name in DERIVED_VIEWS:
+        inputs = DERIVED_VIEWS[name][0]
+        for i in inputs:
+            load_dataset(i, store)
+        if store["versions"].get(name) != _input_versions(store, name):
+            with _name_lock(store, name):
+                with store["lock"]:
+                    args    = [store["frames"][i] for i in inputs]
+                    version = _input_versions(store, name)
+                if store["versions"].get(name) != version:
+                    _install(store, {name: (_build_view(name, args, version), version)})
+    elif name not in store["frames"]:
+        with _name_lock(store, name):
+            if name not in store["frames"]:
+                _install(store, {name: _build_raw(name)})
+    return store["frames"][name]
+
+
+def refresh_datasets(store: dict) -> list:
+    """
+    Revalide les exports déjà chargés et reconstruit ceux qui ont changé,
+    ainsi que les vues dérivées qui en dépendent. Retourne les noms basculés.
+    """
+    updates = {}
+    for name, file_id in DATASETS.items():
+        if name not in store["frames"]:
+            continue   # jamais demandé : sera lu à la demande
+        try:
+            if BUNDLE_DIR:
+                # Pas de source à revalider : on suit le bundle publié par le build
+                latest  = (bundle_manifest() or {}).get("datasets", {}).get(name)
+                changed = latest is not None \
+                    and _as_version(latest["version"]) != store["versions"].get(name)
+            else:
+                # Un autre processus a pu revalider la source avant nous : le
+                # snapshot est alors déjà à jour mais notre frame ne l'est pas.
+                changed = refresh_source(file_id) \
+                    or (snapshot_meta(file_id) or {}).get("sha256") != store["versions"].get(name)
+            if changed:
+                updates[name] = _build_raw(name)
+        except Exception:   # source momentanément indisponible : on garde l'existant
+            continue
+    if not updates:
+        return []
+    with store["lock"]:
+        current = {n: (store["frames"][n], store["versions"].get(n)) for n in store["frames"]}
+    for view, (inputs, _) in DERIVED_VIEWS.items():
+        if view in current and any(i in updates for i in inputs):
+            args    = [updates.get(i, current[i]) for i in inputs]
+            version = tuple(a[1] for a in args)
+            updates[view] = (_build_view(view, [a[0] for a in args], version), version)
+    _install(store, updates)
+    return list(updates)
+
+
+def frame_memory_report(store: dict) -> pd.DataFrame:
+    """Taille résidente de chaque dataset chargé (calculée une fois par version)."""
+    with store["lock"]:
+        current = {n: (store["frames"][n], store["versions"].get(n)) for n in store["frames"]}
+    rows = []
+    for name, (frame, version) in current.items():
+        cached = store["memory"].get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, int(frame.memory_usage(deep=True).sum()))
+            store["memory"][name] = cached
+        rows.append((name, len(frame), frame.shape[1], round(cached[1] / 1e6, 1)))
+    return pd.DataFrame(rows, columns=["Dataset", "Lignes", "Colonnes", "Mémoire (Mo)"])
+
+
+def cache_copy_report(store: dict) -> pd.DataFrame:
+    """
+    Coût évité par le store partagé, par dataset : st.cache_data sérialise le
+    frame à la mise en cache puis le désérialise (copie complète) à chaque
+    appel, dans chaque session et à chaque rerun ; le store rend le même objet
+    (simple lecture de dict). Mesuré une fois par version.
+    """
+    with store["lock"]:
+        current = {n: (store["frames"][n], store["versions"].get(n)) for n in store["frames"]}
+    costs = store.setdefault("copy_cost", {})
+    rows = []
+    for name, (frame, version) in current.items():
+        cached = costs.get(name)
+        if cached is None or cached[0] != version:
+            payload = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+            t0 = time.perf_counter()
+            pickle.loads(payload)
+            copy_s = time.perf_counter() - t0
+            cached = (version, len(payload), copy_s)
+            costs[name] = cached
+        _, size, copy_s = cached
+        rows.append((name, round(size / 1e6, 1), round(copy_s * 1000, 1)))
+    return pd.DataFrame(rows, columns=["Dataset", "Copie évitée (Mo / accès)", "Temps évité (ms / accès)"])
+
+
+@st.cache_resource
+def start_refresher(_store: dict) -> threading.Thread | None:
+    """Démarre (une fois par process) le thread de revalidation périodique."""
+    if REFRESH_INTERVAL <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            try:
+                refresh_datasets(_store)
+            except Exception:   # une vue dérivée en échec ne doit pas tuer le thread
+                pass
+
+    thread = threading.Thread(target=loop, name="defis-refresher", daemon=True)
+    thread.start()
+    return thread
+
+
+def load_datasets(names: list) -> tuple[dict, dict, dict]:
+    """
+    Charge les datasets demandés en parallèle (un thread par dataset).
+    Retourne (frames, durées en secondes, erreurs) indexés par nom :
+    une source en échec n'empêche pas les autres d'être chargées.
+    """
+    ctx   = get_script_run_ctx()
+    store = data_store()
+
+    def timed_load(name: str):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        t0 = time.perf_counter()
+        frame = load_dataset(name, store)
+        return frame, time.perf_counter() - t0
+
+    frames, timings, errors = {}, {}, {}
+    with ThreadPoolExecutor(max_workers=max(len(names), 1)) as pool:
+        futures = {name: pool.submit(timed_load, name) for name in names}
+        for name, future in futures.items():
+            try:
+                frames[name], timings[name] = future.result()
+            except Exception as e:   # source indisponible, fichier illisible…
+                errors[name] = e
+    return frames, timings, errors
+
+
+# Frames déjà résolus pendant l'exécution courante du script
+_run_frames: dict = {}
+
+
+def get_dataset(name: str) -> pd.DataFrame:
+    """Accès paresseux : charge le dataset au premier appel du rerun."""
+    if name not in _run_frames:
+        frames, _, errors = load_datasets([name])
+        if name in errors:
+            raise errors[name]
+        _run_frames.update(frames)
+    return _run_frames[name]
+
+
+# ── Index de recherche (page Recherche Produit) ──────────────────────────────
+# Construits une fois par version de dataset : options triées et positions des
+# lignes par valeur. Une recherche devient un accès dict + iloc, en O(résultat).
+SEARCH_KEYS = {
+    "df":  ["Code CIS", "CIP13", "Dénomination du médicament"],
+    "df2": ["Code dossier", "Nom dispositif"],
+}
+
+
+def build_search_index(frame: pd.DataFrame, columns: list) -> dict:
+    """
+    {colonne: (valeurs triées, {valeur: positions})}. Les positions sont
+    croissantes : frame.iloc[positions] rend les mêmes lignes, dans le même
+    ordre, que frame[frame[colonne] == valeur].
+    """
+    index = {}
+    for col in columns:
+        if col not in frame.columns:
+            continue
+        codes, uniques = pd.factorize(frame[col])          # NaN → -1, ignoré
+        order  = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        rows   = {value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(uniques)}
+        index[col] = (sorted(rows), rows)
+    return index
+
+
+def _store_cached(store: dict, key: str, version, build) -> tuple:
+    """(version, build()) mis en cache dans store["indexes"] : une construction par version."""
+    cached = store["indexes"].get(key)
+    if cached is None or cached[0] != version:
+        with _name_lock(store, f"index:{key}"):
+            cached = store["indexes"].get(key)
+            if cached is None or cached[0] != version:
+                cached = (version, build())
+                with store["lock"]:
+                    store["indexes"][key] = cached
+    return cached
+
+
+def _search_entry(name: str) -> tuple:
+    get_dataset(name)
+    store = data_store()
+    with store["lock"]:
+        frame, version = store["frames"][name], store["versions"].get(name)
+    return _store_cached(
+        store, name, version, lambda: (frame, build_search_index(frame, SEARCH_KEYS[name]))
+    )
+
+
+def search_index(name: str) -> tuple[pd.DataFrame, dict]:
+    """(frame, index) de la version courante d'un dataset, l'index étant bâti sur ce frame."""
+    return _search_entry(name)[1]
+
+
+# ── Recherche unifiée (typeahead) ────────────────────────────────────────────
+# Une seule saisie sur les dénominations, noms de dispositifs et codes : chaque
+# valeur indexée (SEARCH_KEYS) est repliée (minuscules, sans accents ni
+# ponctuation) et découpée en mots, triés pour une recherche par préfixe en
+# O(log n). Chaque mot saisi doit préfixer un mot de la valeur.
+TYPEAHEAD_TOP_K = 20
+_FOLD_LIGATURES = str.maketrans({"œ": "oe", "æ": "ae", "ß": "ss"})
+
+
+def fold_series(values: pd.Series) -> pd.Series:
+    """Repli pour la recherche : 'Crème Œdème-2' → 'creme oedeme 2'."""
+    return (
+        values.astype(str)
+        .str.lower()
+        .str.translate(_FOLD_LIGATURES)
+        .str.normalize("NFKD")
+        .str.replace("[\u0300-\u036f]", "", regex=True)
+        .str.replace(r"[^0-9a-z]+", " ", regex=True)
+        .str.strip()
+    )
+
+
+def build_typeahead_index(indexes: dict) -> dict:
+    """
+    Index de préfixes sur toutes les valeurs des index de recherche {dataset: index} :
+      words / doc_ids   : mots repliés triés → n° de valeur
+      folded / full_ids : valeurs repliées entières triées (préfixe de la saisie complète)
+      rank              : rang de chaque valeur à pertinence égale (plus courte, puis alphabétique)
+    """
+    docs = pd.concat(
+        [
+            pd.DataFrame({"dataset": name, "column": col, "value": pd.Series(options, dtype=object)})
+            for name, index in indexes.items()
+            for col, (options, _) in index.items()
+        ],
+        ignore_index=True,
+    )
+    docs["folded"] = fold_series(docs["value"]).to_numpy(dtype=object)
+    words  = docs["folded"].str.split().explode().dropna()      # index = n° de valeur
+    words  = words[words != ""].sort_values(kind="stable")
+    folded = docs["folded"].sort_values(kind="stable")
+    rank   = np.empty(len(docs), dtype=np.int64)
+    rank[np.lexsort((docs["value"].to_numpy(dtype=str), docs["folded"].str.len().to_numpy()))] = \
+        np.arange(len(docs))
+    return {
+        "docs":     docs,
+        "words":    words.to_numpy(dtype=object),
+        "doc_ids":  words.index.to_numpy(dtype=np.int64),
+        "folded":   folded.to_numpy(dtype=object),
+        "full_ids": folded.index.to_numpy(dtype=np.int64),
+        "rank":     rank,
+    }
+
+
+def _prefix_range(sorted_values: np.ndarray, prefix: str) -> slice:
+    lo = np.searchsorted(sorted_values, prefix, side="left")
+    hi = np.searchsorted(sorted_values, prefix + "\uffff", side="left")
+    return slice(lo, hi)
+
+
+def typeahead_search(index: dict, query: str, k: int = TYPEAHEAD_TOP_K) -> tuple[pd.DataFrame, int]:
+    """
+    Top-k des valeurs dont les mots sont préfixés par tous les mots saisis,
+    avec le nombre total de valeurs correspondantes.
+    Classement : valeur identique à la saisie, puis commençant par la saisie,
+    puis plus courte, puis alphabétique.
+    """
+    folded = fold_series(pd.Series([query])).iloc[0]
+    terms  = folded.split()
+    docs   = index["docs"]
+    if not terms:
+        return docs.iloc[:0], 0
+    n_docs  = len(docs)
+    matched = None
+    for term in sorted(set(terms), key=len, reverse=True):    # les plus sélectifs d'abord
+        mask = np.zeros(n_docs, dtype=bool)
+        mask[index["doc_ids"][_prefix_range(index["words"], term)]] = True
+        matched = mask if matched is None else matched & mask
+        if not matched.any():
+            return docs.iloc[:0], 0
+    candidates = np.flatnonzero(matched)
+
+    tier = np.full(n_docs, 2, dtype=np.int64)
+    tier[index["full_ids"][_prefix_range(index["folded"], folded)]] = 1
+    tier[index["full_ids"][
+        np.searchsorted(index["folded"], folded, side="left"):
+        np.searchsorted(index["folded"], folded, side="right")
+    ]] = 0
+    key  = tier[candidates] * n_docs + index["rank"][candidates]
+    top  = np.argpartition(key, k - 1)[:k] if len(key) > k else np.arange(len(key))
+    return docs.iloc[candidates[top[np.argsort(key[top])]]], len(candidates)
+
+
+def typeahead_index() -> dict:
+    """Index typeahead de la version courante de df et df2."""
+    entries = {name: _search_entry(name) for name in SEARCH_KEYS}
+    version = tuple(entry[0] for entry in entries.values())
+    return _store_cached(
+        data_store(), "typeahead", version,
+        lambda: build_typeahead_index({name: entry[1][1] for name, entry in entries.items()}),
+    )[1]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 6 ter.  BUILD HORS-LIGNE  (python DEFI6.py build --out <répertoire>)
+# ══════════════════════════════════════════════════════════════════════════════
+#
+# Exécute tout le pipeline une fois, hors de l'application : ingestion,
+# normalize_columns, MAPPING_LABO, dédoublonnage, enrich_df3 et agrégats par
+# groupe. Le résultat est un bundle versionné :
+#   <out>/<build_id>/<dataset>.arrow   (Arrow IPC, projeté en mémoire par l'app)
+#   <out>/<build_id>/manifest.json     (empreintes des sources, lignes, durée…)
+#   <out>/current.json                 (pointeur basculé en dernier)
+# L'application le lit avec DEFIS_BUNDLE_DIR=<out>.
+# ──────────────────────────────────────────────────────────────────────────────
+
+def build_bundle(out_dir: Path, keep: int = 3) -> dict:
+    """Construit et publie un bundle complet. Retourne son manifeste."""
+    t0    = time.perf_counter()
+    store = new_store()
+    # Revalidation explicite : un snapshot local ne doit pas masquer une source à jour
+    for file_id in DATASETS.values():
+        refresh_source(file_id)
+    for name in [*DATASETS, *DERIVED_VIEWS]:
+        load_dataset(name, store)
+
+    sources  = {name: store["versions"][name] for name in DATASETS}
+    build_id = datetime.now().strftime("%Y%m%dT%H%M%S") + "-" + hashlib.sha256(
+        json.dumps(sources, sort_keys=True).encode("utf-8")
+    ).hexdigest()[:8]
+    out_dir  = Path(out_dir)
+    staging  = out_dir / f".{build_id}.tmp"
+    staging.mkdir(parents=True, exist_ok=True)
+
+    datasets = {}
+    for name, frame in store["frames"].items():
+        write_arrow(staging / f"{name}.arrow", frame)
+        datasets[name] = {
+            "file":    f"{name}.arrow",
+            "rows":    len(frame),
+            "columns": list(map(str, frame.columns)),
+            "version": store["versions"][name],
+        }
+    manifest = {
+        "format":        BUNDLE_FORMAT,
+        "build_id":      build_id,
+        "built_at":      datetime.now().isoformat(timespec="seconds"),
+        "build_seconds": round(time.perf_counter() - t0, 2),
+        "compact":       COMPACT_MEMORY,
+        "sources":       {name: {"file_id": DATASETS[name], "sha256": sha}
+                          for name, sha in sources.items()},
+        "datasets":      datasets,
+    }
+    (staging / "manifest.json").write_text(
+        json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8"
+    )
+    os.replace(staging, out_dir / build_id)
+
+    pointer_tmp = out_dir / "current.json.tmp"
+    pointer_tmp.write_text(json.dumps({"build_id": build_id}), encoding="utf-8")
+    os.replace(pointer_tmp, out_dir / "current.json")
+
+    # Les bundles les plus anciens au-delà de `keep` sont supprimés
+    builds = sorted(p for p in out_dir.iterdir() if p.is_dir() and not p.name.startswith("."))
+    for old in builds[:-keep] if keep > 0 else []:
+        shutil.rmtree(old, ignore_errors=True)
+    return manifest
+
+
+def main_build(argv: list) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python DEFI6.py build",
+        description="Construit le bundle de données du dashboard DEFIS.",
+    )
+    parser.add_argument("--out", required=True, type=Path, help="répertoire des bundles")
+    parser.add_argument("--keep", type=int, default=3, help="nombre de bundles conservés")
+    args = parser.parse_args(argv)
+
+    manifest = build_bundle(args.out, keep=args.keep)
+    print(f"Bundle {manifest['build_id']} publié en {manifest['build_seconds']} s")
+    for name, entry in manifest["datasets"].items():
+        print(f"  {name:<14} {entry['rows']:>9} lignes")
+    return 0
+
+
+if __name__ == "__main__" and not st.runtime.exists():
+    import sys
+
+    if sys.argv[1:2] == ["build"]:
+        BUNDLE_DIR = None   # le build repart toujours des sources
+        sys.exit(main_build(sys.argv[2:]))
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -420,6 +1505,32 @@ def compute_kpi(dataframe: pd.DataFrame):
     return total, nb_med, nb_dm, taux
 
 
+def lookup_kpi(kpis: pd.DataFrame, group: str):
+    """Même tuple que compute_kpi, lu dans les agrégats group_kpis (indexés par groupe)."""
+    row = kpis.loc[group]
+    return int(row["total"]), int(row["nb_med"]), int(row["nb_dm"]), float(row["taux_asmr_12"])
+
+
+def build_rating_lookup(cube: pd.DataFrame) -> dict:
+    """{(groupe, type_produit, colonne): Series niveau → effectif} à partir de group_cube."""
+    cube = cube.sort_values("premier", kind="stable")
+    return {
+        key: pd.Series(part["effectif"].to_numpy(), index=part["niveau"].to_numpy(dtype=object))
+        for key, part in cube.groupby(
+            ["groupe_racine", "type_produit", "indicateur"], sort=False, observed=True
+        )
+    }
+
+
+def rating_lookup() -> dict:
+    """Distributions SMR / ASMR de tous les groupes, construites une fois par version."""
+    get_dataset("group_cube")
+    store = data_store()
+    with store["lock"]:
+        cube, version = store["frames"]["group_cube"], store["versions"].get("group_cube")
+    return _store_cached(store, "group_cube", version, lambda: build_rating_lookup(cube))[1]
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # 8.  FUZZY MATCHING  (v3 — Jaccard pur, seuil 0.7, sans token_substring)
 # ══════════════════════════════════════════════════════════════════════════════
@@ -500,14 +1611,203 @@ def token_jaccard(label: str, candidate: str) -> float:
     return len(a & b) / len(a | b)
 
 
-def find_candidates(
-    label: str,
-    ref: pd.DataFrame,
-    set_titulaires: set,
-    set_groupes: set,
-    all_groupes: list,
-) -> dict:
+# ── Index inversé jeton → entités ────────────────────────────────────────────
+# Les entités du référentiel sont tokenisées une seule fois ; un label importé
+# n'est comparé qu'aux entités partageant au moins un jeton avec lui (les
+# autres ont un Jaccard nul, donc sous SEUIL_FUZZY).
+
+def build_token_index(entities: list) -> dict:
+    """
+    Pré-tokenise `entities` (dans l'ordre fourni) :
+      entites  : la liste elle-même (ordre = ordre de départage des ex æquo)
+      tailles  : nombre de jetons distincts de chaque entité
+      postings : jeton → positions des entités qui le contiennent
+      vocab    : jeton → identifiant entier
+      incidence: matrice creuse entités × jetons au format long (jeton, pos)
+    """
+    tailles, postings = [], {}
+    for pos, e in enumerate(entities):
+        toks = set(meaningful_tokens(e))
+        tailles.append(len(toks))
+        for t in toks:
+            postings.setdefault(t, []).append(pos)
+    vocab = {t: i for i, t in enumerate(postings)}
+    incidence = pd.DataFrame({
+        "jeton": np.repeat(np.arange(len(postings), dtype=np.int64),
+                           [len(ps) for ps in postings.values()]),
+        "pos":   np.fromiter((p for ps in postings.values() for p in ps), dtype=np.int64),
+    })
+    return {
+        "entites":   list(entities),
+        "tailles":   tailles,
+        "postings":  postings,
+        "vocab":     vocab,
+        "incidence": incidence,
+    }
+
+
+def score_candidates(label: str, index: dict, seuil: float = SEUIL_FUZZY) -> list:
+    """
+    Référence de batch_score_candidates() (via find_candidates) :
+    [(entité, Jaccard)] pour les entités de `index` dont le score est ≥ seuil,
+    triées par score décroissant puis dans l'ordre de l'index — exactement ce
+    que donnerait token_jaccard() sur toutes les entités suivi d'un tri stable.
+    """
+    a = set(meaningful_tokens(label))
+    if not a:
+        return []
+    communs = {}
+    for t in a:
+        for pos in index["postings"].get(t, ()):
+            communs[pos] = communs.get(pos, 0) + 1
+    tailles, scored = index["tailles"], []
+    for pos, inter in communs.items():
+        sc = inter / (len(a) + tailles[pos] - inter)
+        if sc >= seuil:
+            scored.append((pos, sc))
+    scored.sort(key=lambda x: (-x[1], x[0]))
+    return [(index["entites"][pos], sc) for pos, sc in scored]
+
+
+def batch_score_candidates(
+    label_tokens: list,
+    index: dict,
+    seuil: float = SEUIL_FUZZY,
+    top_k: int = 5,
+) -> list:
+    """
+    Version lot de score_candidates() : une liste de top_k (entité, Jaccard)
+    par ensemble de jetons de `label_tokens`, mêmes scores et même ordre.
+
+    Labels et entités sont deux matrices d'incidence creuses (label, jeton) et
+    (jeton, pos) ; leur produit — les intersections |A ∩ B| de tous les couples
+    partageant un jeton — est une jointure sur l'identifiant de jeton suivie
+    d'un comptage, puis |A ∪ B| = |A| + |B| − |A ∩ B|.
+    """
+    out = [[] for _ in label_tokens]
+    vocab = index["vocab"]
+    rows = [(i, vocab[t]) for i, toks in enumerate(label_tokens) for t in toks if t in vocab]
+    if not rows:
+        return out
+
+    lab = pd.DataFrame(rows, columns=["label", "jeton"])
+    inter = (
+        lab.merge(index["incidence"], on="jeton")
+        .groupby(["label", "pos"], sort=False)
+        .size()
+        .reset_index(name="inter")
+    )
+    k  = inter["inter"].to_numpy()
+    na = np.array([len(toks) for toks in label_tokens])[inter["label"].to_numpy()]
+    nb = np.asarray(index["tailles"])[inter["pos"].to_numpy()]
+    inter["score"] = k / (na + nb - k)
+
+    top = (
+        inter[inter["score"] >= seuil]
+        .sort_values(["label", "score", "pos"], ascending=[True, False, True])
+        .groupby("label", sort=False)
+        .head(top_k)
+    )
+    entites = index["entites"]
+    for i, pos, sc in zip(top["label"].tolist(), top["pos"].tolist(), top["score"].tolist()):
+        out[i].append((entites[pos], sc))
+    return out
+
+
+# ── Hiérarchie groupe_racine ↔ Titulaire(s) ──────────────────────────────────
+# Construite une fois par version de df3_enriched : matching, options de
+# correspondance et page Laboratoire y lisent filiales et groupes parents au
+# lieu de refiltrer le référentiel.
+CHOIX_EXCLURE = "❌ Exclure de l'analyse"
+
+def build_hierarchy(df: pd.DataFrame) -> dict:
+    """
+    Index bidirectionnel du référentiel (paires Titulaire(s) / groupe_racine
+    renseignées, ordre de première apparition conservé, comme ref.unique()) :
+      groupes             : liste triée
+      filiales            : groupe → [titulaires]
+      parents             : titulaire → [groupes]
+      index_groupes, index_titulaires   : index de jetons (build_token_index)
+      choix, choix_par_cible            : libellés du sélecteur de référentiel
+                                          partagé ↔ (col_filter, val_filter)
+      lignes : {col_filter: {valeur: positions des lignes de df}} pour
+               Titulaire(s) et groupe_racine (jointure des portefeuilles)
+    """
+    pairs = df[["Titulaire(s)", "groupe_racine"]].dropna().drop_duplicates()
+    tit   = pairs["Titulaire(s)"].astype(object)
+    grp   = pairs["groupe_racine"].astype(object)
+    filiales = {g: list(v) for g, v in tit.groupby(grp, sort=False)}
+    parents  = {t: list(v) for t, v in grp.groupby(tit, sort=False)}
+    # Même ordre que reference_options() ; un titulaire à plusieurs groupes
+    # apparaît sous chacun, sa cible renvoie au premier
+    choix = {CHOIX_EXCLURE: (None, None)}
+    for g in sorted(filiales):
+        choix[f"🏢 {g}"] = ("groupe_racine", g)
+        for t in sorted(filiales[g]):
+            choix[f"🏭 {t} — {g}"] = ("Titulaire(s)", t)
+    choix_par_cible = {("groupe_racine", g): f"🏢 {g}" for g in filiales}
+    choix_par_cible.update(
+        {("Titulaire(s)", t): f"🏭 {t} — {gs[0]}" for t, gs in parents.items()}
+    )
+    choix_par_cible[(None, None)] = CHOIX_EXCLURE
+    return {
+        "groupes":          sorted(filiales),
+        "filiales":         filiales,
+        "parents":          parents,
+        "index_groupes":    build_token_index(sorted(filiales)),
+        "index_titulaires": build_token_index(list(parents)),
+        "choix":            choix,
+        "choix_par_cible":  choix_par_cible,
+        "lignes":           {
+            col: df.groupby(col, observed=True, sort=False).indices
+            for col in ("Titulaire(s)", "groupe_racine")
+        },
+    }
+
+
+def hierarchy_index() -> tuple[pd.DataFrame, dict]:
+    """
+    (frame, hiérarchie) de la version courante de df3_enriched (cf. build_hierarchy),
+    la hiérarchie étant bâtie sur ce frame : ses positions de lignes s'y rapportent.
+    """
+    get_dataset("df3_enriched")
+    store = data_store()
+    with store["lock"]:
+        frame, version = store["frames"]["df3_enriched"], store["versions"].get("df3_enriched")
+    return _store_cached(store, "hierarchy", version, lambda: (frame, build_hierarchy(frame)))[1]
+
+
+def exact_candidates(label: str, hierarchy: dict) -> dict | None:
+    """Étapes 1 et 2 de find_candidates() ; None si le label n'est pas exact."""
+    # ── Étape 1 : exact titulaire ─────────────────────────────────────────────
+    if label in hierarchy["parents"]:
+        grp_parents = list(hierarchy["parents"][label])
+        return dict(match_type="exact_tit", tit_exact=label, grp_parents=grp_parents)
+
+    # ── Étape 2 : exact groupe ────────────────────────────────────────────────
+    if label in hierarchy["filiales"]:
+        filiales = list(hierarchy["filiales"][label])
+        return dict(match_type="exact_grp", grp_exact=label, filiales=filiales)
+    return None
+
+
+def fuzzy_or_none(scored_groupes: list, scored_tits: list) -> dict:
+    """Étapes 3 et 4 de find_candidates() à partir des meilleurs scores."""
+    if scored_groupes or scored_tits:
+        return dict(
+            match_type="fuzzy",
+            fuzzy_grp=scored_groupes,
+            fuzzy_tit=scored_tits,
+        )
+
+    # ── Étape 4 : aucun ───────────────────────────────────────────────────────
+    return dict(match_type="aucun")
+
+
+def find_candidates(label: str, hierarchy: dict) -> dict:
     """
+    Règles de référence, un label à la fois (l'application passe par
+    match_portfolio, tenu d'y rester identique : tests/test_matching.py).
     4 étapes ordonnées :
       1. Exact sur Titulaire(s)       → match_type = 'exact_tit'
       2. Exact sur groupe_racine      → match_type = 'exact_grp'
@@ -520,68 +1820,157 @@ def find_candidates(
     et on retourne les 5 meilleurs toutes sources confondues,
     en évitant les doublons groupe/filiale.
     """
-    # ── Étape 1 : exact titulaire ─────────────────────────────────────────────
-    if label in set_titulaires:
-        grp_parents = ref[ref["Titulaire(s)"] == label]["groupe_racine"].unique().tolist()
-        return dict(match_type="exact_tit", tit_exact=label, grp_parents=grp_parents)
-
-    # ── Étape 2 : exact groupe ────────────────────────────────────────────────
-    if label in set_groupes:
-        filiales = ref[ref["groupe_racine"] == label]["Titulaire(s)"].unique().tolist()
-        return dict(match_type="exact_grp", grp_exact=label, filiales=filiales)
+    exact = exact_candidates(label, hierarchy)
+    if exact is not None:
+        return exact
 
     # ── Étape 3 : fuzzy sur groupes ET titulaires ─────────────────────────────
-    scored_groupes = [
-        (g, token_jaccard(label, g))
-        for g in all_groupes
-    ]
-    scored_groupes = [
-        (g, sc) for g, sc in scored_groupes if sc >= SEUIL_FUZZY
-    ]
-    scored_groupes.sort(key=lambda x: x[1], reverse=True)
+    # Seules les entités partageant un jeton avec le label sont évaluées
+    scored_groupes = score_candidates(label, hierarchy["index_groupes"])
+    scored_tits    = score_candidates(label, hierarchy["index_titulaires"])
+    return fuzzy_or_none(scored_groupes[:5], scored_tits[:5])
 
-    all_titulaires_list = ref["Titulaire(s)"].unique().tolist()
-    scored_tits = [
-        (t, token_jaccard(label, t))
-        for t in all_titulaires_list
-    ]
-    scored_tits = [
-        (t, sc) for t, sc in scored_tits if sc >= SEUIL_FUZZY
-    ]
-    scored_tits.sort(key=lambda x: x[1], reverse=True)
 
-    if scored_groupes or scored_tits:
-        return dict(
-            match_type="fuzzy",
-            fuzzy_grp=scored_groupes[:5],
-            fuzzy_tit=scored_tits[:5],
+def match_portfolio(
+    labels,
+    hierarchy: dict,
+    top_k: int = 5,
+    aliases: dict | None = None,
+) -> list:
+    """
+    find_candidates() pour tout un fichier : un dict par label, dans l'ordre,
+    identique à [find_candidates(l, hierarchy) for l in labels].
+    Les labels en double ne sont traités qu'une fois et l'étape fuzzy est
+    calculée en lot (batch_score_candidates) pour tous les labels non exacts.
+    Les alias mémorisés (cf. load_aliases) passent avant les 4 étapes.
+    """
+    labels  = list(labels)
+    uniques = list(dict.fromkeys(labels))
+    par_label = {l: alias_candidate(l, aliases or {}, hierarchy) for l in uniques}
+    for l in uniques:
+        if par_label[l] is None:
+            par_label[l] = exact_candidates(l, hierarchy)
+
+    fuzzy  = [l for l in uniques if par_label[l] is None]
+    tokens = [set(meaningful_tokens(l)) for l in fuzzy]
+    groupes = batch_score_candidates(tokens, hierarchy["index_groupes"], top_k=top_k)
+    tits    = batch_score_candidates(tokens, hierarchy["index_titulaires"], top_k=top_k)
+    for l, g, t in zip(fuzzy, groupes, tits):
+        par_label[l] = fuzzy_or_none(g, t)
+
+    return [par_label[l] for l in labels]
+
+
+# ── Alias mémorisés ──────────────────────────────────────────────────────────
+# Les correspondances confirmées (label importé → col_filter, val_filter) sont
+# conservées dans une base SQLite locale (DEFIS_ALIAS_DB) : au prochain import
+# du même fichier, ces labels sont résolus sans matching. col_filter NULL =
+# exclusion confirmée. La base s'exporte / s'importe en JSON.
+ALIAS_DB = Path(
+    os.environ.get("DEFIS_ALIAS_DB", Path(__file__).resolve().parent / ".aliases.sqlite")
+)
+
+
+def _alias_db() -> sqlite3.Connection:
+    ALIAS_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(ALIAS_DB, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS aliases ("
+        " label_import TEXT PRIMARY KEY,"
+        " col_filter   TEXT,"
+        " val_filter   TEXT,"
+        " updated_at   TEXT NOT NULL)"
+    )
+    return conn
+
+
+def load_aliases() -> dict:
+    """{label_import: (col_filter, val_filter)} de tous les alias mémorisés."""
+    try:
+        with closing(_alias_db()) as conn:
+            rows = conn.execute("SELECT label_import, col_filter, val_filter FROM aliases").fetchall()
+    except sqlite3.Error:
+        return {}
+    return {label: (col, val) for label, col, val in rows}
+
+
+def save_aliases(decisions: list) -> int:
+    """Enregistre (ou remplace) des décisions (label_import, col_filter, val_filter)."""
+    now = datetime.now().isoformat(timespec="seconds")
+    rows = [(str(label), col, None if col is None else str(val), now)
+            for label, col, val in decisions]
+    with closing(_alias_db()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO aliases VALUES (?, ?, ?, ?)", rows
         )
+    return len(rows)
 
-    # ── Étape 4 : aucun ───────────────────────────────────────────────────────
-    return dict(match_type="aucun")
 
+def export_aliases() -> bytes:
+    """Alias mémorisés au format JSON (liste de décisions), pour un autre poste."""
+    return json.dumps(
+        [
+            {"label_import": label, "col_filter": col, "val_filter": val}
+            for label, (col, val) in sorted(load_aliases().items())
+        ],
+        ensure_ascii=False, indent=1,
+    ).encode("utf-8")
 
-def build_selectbox_options(
-    c: dict,
-    label: str,
-    ref: pd.DataFrame,
-    all_groupes: list,
-) -> list:
+
+def import_aliases(data: bytes) -> int:
+    """Fusionne un export JSON d'alias ; ValueError si le contenu est invalide."""
+    try:
+        items = json.loads(data)
+        decisions = [(d["label_import"], d["col_filter"], d["val_filter"]) for d in items]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"export d'alias invalide : {e}") from e
+    if any(col not in (None, "Titulaire(s)", "groupe_racine") for _, col, _ in decisions):
+        raise ValueError("col_filter doit valoir Titulaire(s), groupe_racine ou null")
+    return save_aliases(decisions)
+
+
+def alias_candidate(label: str, aliases: dict, hierarchy: dict) -> dict | None:
+    """
+    Candidat 'alias' si le label a une décision mémorisée dont la cible existe
+    encore dans le référentiel courant ; None sinon (matching habituel).
+    """
+    if label not in aliases:
+        return None
+    col, val = aliases[label]
+    known = {"Titulaire(s)": hierarchy["parents"], "groupe_racine": hierarchy["filiales"]}
+    if col is not None and val not in known.get(col, ()):
+        return None
+    return dict(match_type="alias", col_filter=col, val_filter=val)
+
+
+def build_selectbox_options(c: dict, label: str, hierarchy: dict) -> list:
     """
     Construit la liste (col_filter, val_filter, description_affichée).
     col_filter = None  →  option "Exclure" ou séparateur visuel (non sélectionnable).
 
     Cas 'aucun' : propose ❌ Exclure en tête,
                   puis TOUS les groupe_racine avec leurs filiales.
+    Cas 'alias' : la décision mémorisée en tête, puis comme 'aucun'.
     """
     opts = []
 
+    # ── alias mémorisé ────────────────────────────────────────────────────────
+    if c["match_type"] == "alias":
+        if c["col_filter"] is None:
+            opts.append((None, None, "📌 Exclure (alias mémorisé)"))
+        else:
+            niveau = "Titulaire" if c["col_filter"] == "Titulaire(s)" else "Groupe racine"
+            opts.append((c["col_filter"], c["val_filter"],
+                         f"📌 {niveau} (alias mémorisé) : {c['val_filter']}"))
+            opts.append((None, None, "❌ Exclure de l'analyse"))
+        opts.extend(reference_options(hierarchy))
+
     # ── exact titulaire ───────────────────────────────────────────────────────
-    if c["match_type"] == "exact_tit":
+    elif c["match_type"] == "exact_tit":
         opts.append(("Titulaire(s)", label, f"🏭 Titulaire (exact) : {label}"))
         for g in c["grp_parents"]:
             opts.append(("groupe_racine", g, f"🏢 Groupe racine parent : {g}"))
-            for t in ref[ref["groupe_racine"] == g]["Titulaire(s)"].unique():
+            for t in hierarchy["filiales"][g]:
                 if t != label:
                     opts.append(("Titulaire(s)", t, f"   ↳ 🏭 Autre filiale : {t}"))
 
@@ -601,7 +1990,7 @@ def build_selectbox_options(
         # Groupes fuzzy
         for g, score in c.get("fuzzy_grp", []):
             icon = "🟢" if score >= 0.85 else "🔶"
-            filiales = ref[ref["groupe_racine"] == g]["Titulaire(s)"].unique().tolist()
+            filiales = hierarchy["filiales"][g]
             opts.append((
                 "groupe_racine", g,
                 f"{icon} Groupe ({score:.0%}) : {g}  [{len(filiales)} filiale(s)]",
@@ -613,8 +2002,8 @@ def build_selectbox_options(
         # Titulaires fuzzy (si leur groupe n'est pas déjà listé)
         for t, score in c.get("fuzzy_tit", []):
             icon = "🟢" if score >= 0.85 else "🔶"
-            grp = ref[ref["Titulaire(s)"] == t]["groupe_racine"].values
-            grp_str = grp[0] if len(grp) else "?"
+            grp = hierarchy["parents"].get(t, [])
+            grp_str = grp[0] if grp else "?"
             if grp_str not in seen_groupes:
                 opts.append((
                     "Titulaire(s)", t,
@@ -626,18 +2015,39 @@ def build_selectbox_options(
     # ── aucun : ❌ en tête + référentiel complet ──────────────────────────────
     else:
         opts.append((None, None, "❌ Exclure (aucune correspondance automatique)"))
-        opts.append((None, None, "─── Référentiel complet — choisir manuellement ───"))
-        for g in sorted(all_groupes):
-            filiales = ref[ref["groupe_racine"] == g]["Titulaire(s)"].unique().tolist()
-            opts.append((
-                "groupe_racine", g,
-                f"🏢 {g}  [{len(filiales)} filiale(s)]",
-            ))
-            for t in sorted(filiales):
-                opts.append(("Titulaire(s)", t, f"   ↳ 🏭 {t}"))
+        opts.extend(reference_options(hierarchy))
 
     return opts
 
+
+def default_choice(c: dict, label: str) -> tuple:
+    """(col_filter, val_filter) de la 1re option de build_selectbox_options(c, label)."""
+    if c["match_type"] == "alias":
+        return c["col_filter"], c["val_filter"]
+    if c["match_type"] == "exact_tit":
+        return "Titulaire(s)", label
+    if c["match_type"] == "exact_grp":
+        return "groupe_racine", label
+    if c["match_type"] == "fuzzy":
+        if c["fuzzy_grp"]:
+            return "groupe_racine", c["fuzzy_grp"][0][0]
+        return "Titulaire(s)", c["fuzzy_tit"][0][0]
+    return None, None
+
+
+def reference_options(hierarchy: dict) -> list:
+    """Séparateur puis TOUS les groupe_racine avec leurs filiales (choix manuel)."""
+    opts = [(None, None, "─── Référentiel complet — choisir manuellement ───")]
+    for g in hierarchy["groupes"]:
+        filiales = hierarchy["filiales"][g]
+        opts.append((
+            "groupe_racine", g,
+            f"🏢 {g}  [{len(filiales)} filiale(s)]",
+        ))
+        for t in sorted(filiales):
+            opts.append(("Titulaire(s)", t, f"   ↳ 🏭 {t}"))
+    return opts
+
 # ══════════════════════════════════════════════════════════════════════════════
 # 9.  SIDEBAR
 # ══════════════════════════════════════════════════════════════════════════════
@@ -668,19 +2078,92 @@ with st.sidebar:
         f"{datetime.now().strftime('%d %b %Y')}</strong></div>",
         unsafe_allow_html=True,
     )
+    if st.button("🔄 Recharger les données", use_container_width=True,
+                 help="Ignore les snapshots locaux et re-télécharge les exports"):
+        invalidate_snapshot()
+        with st.spinner("Rechargement des sources…"):
+            refresh_datasets(data_store())
+        st.rerun()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# 10.  PAGE 1 — RECHERCHE PRODUIT
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Recherche par lot : codes acceptés, (dataset, colonne)
+BATCH_KEYS = [("df", "Code CIS"), ("df", "CIP13"), ("df2", "Code dossier")]
+
+
+def parse_code_list(text: str = "", upload=None) -> pd.Series:
+    """
+    Codes saisis (séparés par espaces, virgules, points-virgules) et/ou importés
+    (première colonne d'un CSV/TXT/Excel). Nettoyés, dédoublonnés, ordre conservé.
+    """
+    parts = [pd.Series(re.split(r"[\s,;]+", text or ""), dtype=object)]
+    if upload is not None:
+        if upload.name.lower().endswith((".xlsx", ".xls")):
+            cells = pd.read_excel(upload, header=None, dtype=str, usecols=[0]).iloc[:, 0]
+        else:
+            raw   = upload.getvalue()
+            lines = pd.Series(raw.decode(detect_encoding(raw), errors="replace").splitlines(), dtype=object)
+            cells = lines.str.split(r"[,;\t]", n=1, regex=True).str[0]
+        parts.append(cells.astype(object))
+    codes = (
+        pd.concat(parts, ignore_index=True)
+        .dropna()
+        .astype(str)
+        .str.strip()
+        .str.replace(r"\.0$", "", regex=True)      # nombres relus depuis Excel
+    )
+    headers = {"code", "codes"} | {col.lower() for _, col in BATCH_KEYS}
+    codes = codes[(codes != "") & ~codes.str.lower().isin(headers)]
+    return codes.drop_duplicates().reset_index(drop=True)
+
+
+def batch_lookup(codes: pd.Series, sources: dict) -> tuple[pd.DataFrame, pd.Series]:
+    """
+    Résout tous les codes d'un coup via les index de recherche : sources =
+    {dataset: (frame, index)} (cf. search_index). Coût O(codes + résultat).
+    Retourne (lignes trouvées, dans l'ordre de saisie, avec le code saisi et
+    son type ; codes introuvables).
+    """
+    values = codes.to_numpy(dtype=object)
+    found, ordre = [], []
+    for name, col in BATCH_KEYS:
+        frame, index = sources[name]
+        if col not in index:
+            continue
+        rows      = index[col][1]
+        positions = [rows.get(code, ()) for code in values]
+        lengths   = np.fromiter(map(len, positions), dtype=np.int64, count=len(values))
+        if not lengths.any():
+            continue
+        hits = frame.iloc[np.concatenate(positions).astype(np.int64)].reset_index(drop=True)
+        hits.insert(0, "Code saisi", np.repeat(values, lengths))
+        hits.insert(1, "Type de code", col)
+        found.append(hits)
+        ordre.append(np.repeat(np.arange(len(values)), lengths))
+    if not found:
+        return pd.DataFrame(columns=["Code saisi", "Type de code"]), codes.reset_index(drop=True)
+    result  = pd.concat(found, ignore_index=True)
+    result  = result.iloc[np.argsort(np.concatenate(ordre), kind="stable")].reset_index(drop=True)
+    missing = codes[~codes.isin(set(result["Code saisi"]))].reset_index(drop=True)
+    return result, missing
 
 
-# ══════════════════════════════════════════════════════════════════════════════
-# 10.  PAGE 1 — RECHERCHE PRODUIT
-# ══════════════════════════════════════════════════════════════════════════════
 def page_recherche():
+    df,  df_index  = search_index("df")
+    df2, df2_index = search_index("df2")
+
     st.markdown('<div class="page-title">🔎 Recherche Produit</div>', unsafe_allow_html=True)
     st.markdown(
         '<div class="page-subtitle">Retrouvez les informations d\'un médicament ou d\'un dispositif médical</div>',
         unsafe_allow_html=True,
     )
 
-    tab_med, tab_dm = st.tabs(["💊 Médicament", "🩺 Dispositif Médical"])
+    tab_med, tab_dm, tab_quick, tab_batch = st.tabs(
+        ["💊 Médicament", "🩺 Dispositif Médical", "⚡ Recherche unifiée", "📋 Recherche par lot"]
+    )
 
     with tab_med:
         col_opts, col_search = st.columns([1, 2], gap="large")
@@ -691,17 +2174,15 @@ def page_recherche():
         with col_search:
             section_header("Sélection")
             if option == "Code CIS":
-                values, col_filter = sorted(df["Code CIS"].dropna().unique()), "Code CIS"
+                col_filter = "Code CIS"
             elif option == "CIP13":
-                values, col_filter = sorted(df["CIP13"].dropna().unique()), "CIP13"
+                col_filter = "CIP13"
             else:
-                values, col_filter = (
-                    sorted(df["Dénomination du médicament"].dropna().unique()),
-                    "Dénomination du médicament",
-                )
+                col_filter = "Dénomination du médicament"
+            values, rows = df_index[col_filter]
             search_value = st.selectbox(f"Sélectionner ({len(values)} disponibles) :", values)
 
-        med_df = df[df[col_filter] == search_value]
+        med_df = df.iloc[rows.get(search_value, [])]
         st.markdown("<hr class='thin'>", unsafe_allow_html=True)
 
         c1, c2, c3 = st.columns(3)
@@ -735,7 +2216,7 @@ def page_recherche():
         with col_dl:
             st.download_button(
                 "📥 Exporter Excel",
-                data=export_excel(med_df),
+                data=lambda: export_excel(med_df),
                 file_name=f"medicament_{search_value}_{datetime.now().date()}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 use_container_width=True,
@@ -751,19 +2232,12 @@ def page_recherche():
             )
         with col_search2:
             section_header("Sélection")
-            if search_option == "Code dossier HAS":
-                values_dm = sorted(df2["Code dossier"].dropna().astype(str).unique())
-                col_dm = "Code dossier"
-            else:
-                values_dm = sorted(df2["Nom dispositif"].dropna().unique())
-                col_dm = "Nom dispositif"
+            # Code dossier est lu en texte (DATASET_SCHEMAS) : plus de conversion ici
+            col_dm = "Code dossier" if search_option == "Code dossier HAS" else "Nom dispositif"
+            values_dm, rows_dm = df2_index[col_dm]
             search_dm = st.selectbox(f"Sélectionner ({len(values_dm)} disponibles) :", values_dm)
 
-        dispo_df = (
-            df2[df2[col_dm].astype(str) == search_dm]
-            if search_option == "Code dossier HAS"
-            else df2[df2[col_dm] == search_dm]
-        )
+        dispo_df = df2.iloc[rows_dm.get(search_dm, [])]
         st.markdown("<hr class='thin'>", unsafe_allow_html=True)
 
         if dispo_df.empty:
@@ -777,24 +2251,114 @@ def page_recherche():
             with col_dl2:
                 st.download_button(
                     "📥 Exporter Excel",
-                    data=export_excel(dispo_df),
+                    data=lambda: export_excel(dispo_df),
                     file_name=f"dispositif_{search_dm}_{datetime.now().date()}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     use_container_width=True,
                 )
 
+    with tab_quick:
+        section_header("Dénomination, nom de dispositif ou code (CIS, CIP13, dossier HAS)")
+        query = st.text_input(
+            "Rechercher :", placeholder="ex. doliprane 500, 3400930, pansement…",
+            label_visibility="collapsed",
+        )
+        if query.strip():
+            quick_index = typeahead_index()
+            t0   = time.perf_counter()
+            hits, total = typeahead_search(quick_index, query)
+            st.caption(f"{total} résultat(s) en {(time.perf_counter() - t0) * 1000:.1f} ms"
+                       + (f" — {len(hits)} premiers affichés" if total > len(hits) else ""))
+            if hits.empty:
+                st.warning("⚠️ Aucun produit ne correspond à cette saisie.")
+            else:
+                kinds  = {"df": "💊", "df2": "🩺"}
+                labels = [f"{kinds[d]} {v}  ·  {c}" for d, c, v in
+                          zip(hits["dataset"], hits["column"], hits["value"])]
+                pick = st.selectbox("Résultats :", range(len(hits)), format_func=labels.__getitem__)
+                hit  = hits.iloc[pick]
+                frame, index = (df, df_index) if hit["dataset"] == "df" else (df2, df2_index)
+                quick_df = frame.iloc[index[hit["column"]][1].get(hit["value"], [])]
+
+                st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+                kpi_card("Résultats trouvés", len(quick_df))
+                st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+                section_header("Données détaillées")
+                st.dataframe(quick_df, use_container_width=True, height=320)
+
+    with tab_batch:
+        section_header("Codes CIS, CIP13 ou dossier HAS")
+        col_paste, col_file = st.columns(2, gap="large")
+        with col_paste:
+            pasted = st.text_area(
+                "Coller des codes :", height=150,
+                placeholder="Un code par ligne, ou séparés par des virgules / points-virgules",
+            )
+        with col_file:
+            batch_file = st.file_uploader(
+                "… ou importer un fichier (codes en première colonne)",
+                type=["csv", "txt", "xlsx", "xls"],
+            )
+
+        try:
+            codes = parse_code_list(pasted, batch_file)
+        except Exception as e:
+            st.error(f"❌ Impossible de lire le fichier : {e}")
+            codes = pd.Series(dtype=object)
+
+        if codes.empty:
+            st.info("📋 Collez ou importez une liste de codes pour lancer la recherche.")
+        else:
+            batch_df, missing = batch_lookup(codes, {"df": (df, df_index), "df2": (df2, df2_index)})
+            st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+            c1, c2, c3 = st.columns(3)
+            with c1: kpi_card("Codes saisis", len(codes))
+            with c2: kpi_card("✅ Trouvés", len(codes) - len(missing))
+            with c3: kpi_card("❌ Introuvables", len(missing))
+
+            st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+            section_header(f"Résultats ({len(batch_df)} lignes)")
+            st.dataframe(batch_df, use_container_width=True, height=320)
+            if not missing.empty:
+                with st.expander(f"❌ {len(missing)} code(s) introuvable(s)"):
+                    st.dataframe(missing.to_frame("Code saisi"), use_container_width=True, hide_index=True)
+
+            col_dl3, col_dl4, _ = st.columns([1, 1, 2])
+            with col_dl3:
+                st.download_button(
+                    "📥 Exporter les résultats",
+                    data=lambda: export_excel(batch_df, sheet_name="Résultats"),
+                    file_name=f"recherche_lot_{datetime.now().date()}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    use_container_width=True,
+                    disabled=batch_df.empty,
+                )
+            with col_dl4:
+                st.download_button(
+                    "📥 Exporter les introuvables",
+                    data=lambda: export_excel(missing.to_frame("Code saisi"), sheet_name="Introuvables"),
+                    file_name=f"codes_introuvables_{datetime.now().date()}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    use_container_width=True,
+                    disabled=missing.empty,
+                )
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 # 11.  PAGE 2 — ANALYSE LABORATOIRE
 # ══════════════════════════════════════════════════════════════════════════════
 def page_laboratoire():
+    df3_enriched = get_dataset("df3_enriched")
+    kpis         = get_dataset("group_kpis").set_index("groupe_racine")
+    ratings      = rating_lookup()
+
     st.markdown('<div class="page-title">🏢 Analyse Laboratoire</div>', unsafe_allow_html=True)
     st.markdown(
-        '<div class="page-subtitle">Explorez le profil qualité d\'un groupe ou comparez deux groupes</div>',
+        '<div class="page-subtitle">Explorez le profil qualité d\'un groupe ou comparez plusieurs groupes</div>',
         unsafe_allow_html=True,
     )
 
-    groups = sorted(df3_enriched["groupe_racine"].dropna().unique())
+    groups = sorted(kpis.index)
 
     with st.expander("⚙️ Configuration de l'analyse", expanded=True):
         col_g1, col_mode, col_g2 = st.columns([2, 1, 2], gap="large")
@@ -805,49 +2369,70 @@ def page_laboratoire():
             st.markdown("**Mode**")
             compare_mode = st.toggle("Comparer", value=False)
         with col_g2:
-            st.markdown("**Groupe de comparaison**")
+            st.markdown("**Groupes de comparaison**")
+            others = [g for g in groups if g != group_1]
             if compare_mode:
-                group_2 = st.selectbox(
-                    "Comparer avec :", [g for g in groups if g != group_1],
-                    label_visibility="collapsed",
+                group_others = st.multiselect(
+                    "Comparer avec :", others, default=others[:1],
+                    placeholder="Choisir un ou plusieurs groupes", label_visibility="collapsed",
                 )
             else:
-                st.selectbox("Comparer avec :", groups, disabled=True, label_visibility="collapsed")
-                group_2 = None
+                st.multiselect("Comparer avec :", groups, disabled=True, label_visibility="collapsed")
+                group_others = []
 
-    df_g1 = df3_enriched[df3_enriched["groupe_racine"] == group_1]
-    df_g2 = df3_enriched[df3_enriched["groupe_racine"] == group_2] if compare_mode and group_2 else None
+    # Groupes affichés : le principal puis ceux de comparaison
+    compared = [group_1] + group_others
+    per_row  = min(len(compared), 3)
+
+    def group_columns():
+        """Colonnes par rangées de `per_row`, une par groupe comparé."""
+        for start in range(0, len(compared), per_row):
+            row = st.columns(per_row, gap="large")
+            yield from zip(row, compared[start:start + per_row])
 
     st.markdown("<hr class='thin'>", unsafe_allow_html=True)
     section_header("🔎 Filiales du groupe")
 
-    groups_to_show = [group_1] + ([group_2] if compare_mode and group_2 else [])
-    cols_exp = st.columns(len(groups_to_show), gap="large")
-    for i, group in enumerate(groups_to_show):
-        with cols_exp[i]:
-            gdf = df3_enriched[df3_enriched["groupe_racine"] == group]
-            with st.expander(f"**{group}** — {len(gdf)} produits"):
-                for t in sorted(gdf["Titulaire(s)"].dropna().unique()):
+    _, hierarchy = hierarchy_index()
+    for col, group in group_columns():
+        with col:
+            with st.expander(f"**{group}** — {int(kpis['total'].get(group, 0))} produits"):
+                for t in sorted(hierarchy["filiales"].get(group, [])):
                     st.markdown(f"- {t}")
 
     st.markdown("<hr class='thin'>", unsafe_allow_html=True)
     section_header("📌 Indicateurs clés")
 
-    total1, nb_med1, nb_dm1, taux1 = compute_kpi(df_g1)
-    if not compare_mode:
+    total1, nb_med1, nb_dm1, taux1 = lookup_kpi(kpis, group_1)
+    if len(compared) == 1:
         c1, c2, c3, c4 = st.columns(4)
         with c1: kpi_card("Total produits", total1)
         with c2: kpi_card("💊 Médicaments", nb_med1)
         with c3: kpi_card("🩺 Dispositifs", nb_dm1)
         with c4: kpi_card("% ASMR I-II", f"{taux1:.1f}%")
-    else:
-        total2, nb_med2, nb_dm2, taux2 = compute_kpi(df_g2)
+    elif len(compared) == 2:
+        group_2 = compared[1]
+        total2, nb_med2, nb_dm2, taux2 = lookup_kpi(kpis, group_2)
         c1, c2, c3, c4 = st.columns(4)
         with c1: kpi_card("Total", f"{total1} vs {total2}", delta=total1 - total2)
         with c2: kpi_card("💊 Médicaments", f"{nb_med1} vs {nb_med2}", delta=nb_med1 - nb_med2)
         with c3: kpi_card("🩺 Dispositifs", f"{nb_dm1} vs {nb_dm2}", delta=nb_dm1 - nb_dm2)
         with c4: kpi_card("% ASMR I-II", f"{taux1:.1f}% vs {taux2:.1f}%",
                           delta=round(taux1 - taux2, 1), delta_label="pts")
+    else:
+        table = pd.DataFrame(
+            [lookup_kpi(kpis, g) for g in compared],
+            index=pd.Index(compared, name="Groupe"),
+            columns=["Total produits", "💊 Médicaments", "🩺 Dispositifs", "% ASMR I-II"],
+        )
+        table["Écart % ASMR I-II (pts)"] = table["% ASMR I-II"] - taux1
+        st.dataframe(
+            table, use_container_width=True,
+            column_config={
+                "% ASMR I-II": st.column_config.NumberColumn(format="%.1f%%"),
+                "Écart % ASMR I-II (pts)": st.column_config.NumberColumn(format="%+.1f"),
+            },
+        )
 
     st.markdown("<hr class='thin'>", unsafe_allow_html=True)
     section_header("📊 Analyse qualitative")
@@ -865,69 +2450,99 @@ def page_laboratoire():
     cmap_m = SMR_COLORS_SHORT  if choix == "SMR / SR" else ASMR_COLORS_SHORT
     cmap_d = SR_COLORS_SHORT   if choix == "SMR / SR" else ASR_COLORS_SHORT
 
-    med_g1 = df_g1[df_g1["type_produit"] == "medicament"]
-    dm_g1  = df_g1[df_g1["type_produit"] == "dispositif_medical"]
+    # Effectifs par niveau lus dans le cube (Series vide si aucun produit)
+    def counts(group, type_produit) -> pd.Series:
+        return ratings.get((group, type_produit, col_valeur), pd.Series(dtype="int64"))
 
-    if not compare_mode:
+    if not compare_mode or len(compared) == 1:
+        med_g1 = counts(group_1, "medicament")
+        dm_g1  = counts(group_1, "dispositif_medical")
         col_left, col_right = st.columns(2, gap="large")
         with col_left:
             if not med_g1.empty:
-                plot_pie(med_g1, col_valeur, f"{lbl_m} – Médicaments ({group_1})",
-                         label_map=lmap_m, color_map=cmap_m)
+                plot_pie(None, col_valeur, f"{lbl_m} – Médicaments ({group_1})",
+                         label_map=lmap_m, color_map=cmap_m, counts=med_g1)
             else:
                 st.info("Aucun médicament pour ce groupe.")
         with col_right:
             if not dm_g1.empty:
-                plot_pie(dm_g1, col_valeur, f"{lbl_d} – Dispositifs ({group_1})",
-                         label_map=lmap_d, color_map=cmap_d)
+                plot_pie(None, col_valeur, f"{lbl_d} – Dispositifs ({group_1})",
+                         label_map=lmap_d, color_map=cmap_d, counts=dm_g1)
             else:
                 st.info("Aucun dispositif médical pour ce groupe.")
     else:
-        med_g2 = df_g2[df_g2["type_produit"] == "medicament"]
-        dm_g2  = df_g2[df_g2["type_produit"] == "dispositif_medical"]
-        st.markdown(f"**Médicaments — {lbl_m}**")
-        c1, c2 = st.columns(2, gap="large")
-        with c1:
-            if not med_g1.empty:
-                plot_pie(med_g1, col_valeur, group_1, label_map=lmap_m, color_map=cmap_m)
-        with c2:
-            if not med_g2.empty:
-                plot_pie(med_g2, col_valeur, group_2, label_map=lmap_m, color_map=cmap_m)
-        st.markdown(f"**Dispositifs — {lbl_d}**")
-        c3, c4 = st.columns(2, gap="large")
-        with c3:
-            if not dm_g1.empty:
-                plot_pie(dm_g1, col_valeur, group_1, label_map=lmap_d, color_map=cmap_d)
-        with c4:
-            if not dm_g2.empty:
-                plot_pie(dm_g2, col_valeur, group_2, label_map=lmap_d, color_map=cmap_d)
+        for type_produit, titre, lmap, cmap in (
+            ("medicament",         f"Médicaments — {lbl_m}", lmap_m, cmap_m),
+            ("dispositif_medical", f"Dispositifs — {lbl_d}", lmap_d, cmap_d),
+        ):
+            st.markdown(f"**{titre}**")
+            for col, group in group_columns():
+                with col:
+                    group_counts = counts(group, type_produit)
+                    if not group_counts.empty:
+                        plot_pie(None, col_valeur, group, label_map=lmap, color_map=cmap,
+                                 counts=group_counts)
+
+    st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+    section_header("🏆 Classement des groupes")
+
+    board   = get_dataset("group_leaderboard")
+    metrics = [c for c in board.columns
+               if c != "groupe_racine" and not c.endswith(LEADERBOARD_CENTILE)]
+    col_rank, _ = st.columns([2, 3])
+    with col_rank:
+        metric = st.selectbox("Classer selon :", metrics, index=metrics.index("% ASMR I-II"))
+    ranked = board.sort_values(metric, ascending=False, kind="stable")
+    leaderboard = ranked[["groupe_racine", *metrics]].rename(columns={"groupe_racine": "Groupe"})
+    leaderboard.insert(0, "Rang", np.arange(1, len(ranked) + 1))
+    leaderboard.insert(2, "Centile", ranked[f"{metric}{LEADERBOARD_CENTILE}"].to_numpy())
+    leaderboard.insert(0, "", np.where(leaderboard["Groupe"].isin(compared), "★", ""))
+    st.caption(
+        f"{len(leaderboard)} groupes classés selon **{metric}** — centile 100 = valeur la plus "
+        "élevée. ★ = groupes analysés ci-dessus. Cliquez sur un en-tête pour trier."
+    )
+    st.dataframe(
+        leaderboard, use_container_width=True, hide_index=True, height=360,
+        column_config={
+            c: st.column_config.NumberColumn(format="%.1f")
+            for c in ["Centile", *metrics] if c.startswith("%") or c == "Centile"
+        },
+    )
 
     st.markdown("<hr class='thin'>", unsafe_allow_html=True)
     section_header("📥 Export")
-    col_dl1, col_dl2, _ = st.columns([1, 1, 2])
-    with col_dl1:
+    for start in range(0, len(compared), 4):
+        cols_dl = st.columns(4)
+        for col, group in zip(cols_dl, compared[start:start + 4]):
+            with col:
+                st.download_button(
+                    f"📥 {group} (Excel)",
+                    data=lambda group=group: export_excel(
+                        df3_enriched[df3_enriched["groupe_racine"] == group]
+                    ),
+                    file_name=f"export_{group}_{datetime.now().date()}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    use_container_width=True,
+                )
+    col_dl_board, _ = st.columns([1, 3])
+    with col_dl_board:
         st.download_button(
-            f"📥 {group_1} (Excel)",
-            data=export_excel(df_g1),
-            file_name=f"export_{group_1}_{datetime.now().date()}.xlsx",
+            "📥 Classement (Excel)",
+            data=lambda: export_excel(leaderboard, sheet_name="Classement"),
+            file_name=f"classement_groupes_{datetime.now().date()}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True,
         )
-    if compare_mode and df_g2 is not None:
-        with col_dl2:
-            st.download_button(
-                f"📥 {group_2} (Excel)",
-                data=export_excel(df_g2),
-                file_name=f"export_{group_2}_{datetime.now().date()}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True,
-            )
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # 12.  PAGE 3 — CHIFFRE D'AFFAIRES
 # ══════════════════════════════════════════════════════════════════════════════
 def page_ca():
+    import plotly.express as px
+
+    df1 = get_dataset("df1")
+
     st.markdown('<div class="page-title">💰 Chiffre d\'Affaires</div>', unsafe_allow_html=True)
     st.markdown(
         '<div class="page-subtitle">Ventilation du CA par médicament pour les laboratoires disponibles</div>',
@@ -1020,6 +2635,7 @@ def page_ca():
         df_c = df_ca.copy()
         df_c["_label"] = (
             df_c[col]
+            .astype(object)
             .fillna("Non renseigné")
             .astype(str)
             .str.strip()
@@ -1118,7 +2734,7 @@ def page_ca():
     with col_dl:
         st.download_button(
             "📥 Exporter Excel",
-            data=export_excel(lab_ca_df),
+            data=lambda: export_excel(lab_ca_df),
             file_name=f"CA_{lab_name_ca}_{datetime.now().date()}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True,
@@ -1128,6 +2744,538 @@ def page_ca():
 # ══════════════════════════════════════════════════════════════════════════════
 # 13.  PAGE 4 — PORTEFEUILLE
 # ══════════════════════════════════════════════════════════════════════════════
+def parse_portfolio(data: bytes) -> pd.DataFrame:
+    """
+    Lit le fichier de pondérations (Titulaire(s) | Pondérations) et renvoie
+    label_import / poids, poids > 0. ValueError avec un message affichable.
+    """
+    try:
+        import openpyxl as _openpyxl
+        _wb = _openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        _ws = _wb.active
+        _rows = list(_ws.iter_rows(values_only=True))
+        _wb.close()
+    except Exception as e:
+        raise ValueError(f"Impossible de lire le fichier : {e}") from e
+    if not _rows or len(_rows) < 2:
+        raise ValueError("Le fichier est vide ou ne contient qu'une ligne d'en-tête.")
+    _headers = [str(c).strip() if c is not None else "" for c in _rows[0]]
+    raw_import = pd.DataFrame(_rows[1:], columns=_headers)
+
+    if not {"Titulaire(s)", "Pondérations"}.issubset(set(raw_import.columns)):
+        raise ValueError(
+            f"Colonnes trouvées : `{raw_import.columns.tolist()}` — "
+            "attendu : Titulaire(s) et Pondérations"
+        )
+
+    raw_import = raw_import[["Titulaire(s)", "Pondérations"]].dropna()
+    raw_import.columns = ["label_import", "poids"]
+    raw_import["poids"] = pd.to_numeric(raw_import["poids"], errors="coerce").fillna(0)
+    raw_import = raw_import[raw_import["poids"] > 0].reset_index(drop=True)
+
+    if raw_import.empty:
+        raise ValueError("Aucune pondération > 0 trouvée dans le fichier.")
+    return raw_import
+
+
+# Lecture et matching d'un import sont mémorisés dans la session, indexés par
+# l'empreinte du fichier (+ version de df3_enriched et alias pour le matching) :
+# un changement de sélection ne relance ni openpyxl ni le matching, seulement
+# l'agrégation en aval.
+
+def portfolio_upload(data: bytes) -> tuple[str, pd.DataFrame]:
+    """(empreinte, parse_portfolio(data)), relu seulement si le fichier change."""
+    digest = hashlib.sha256(data).hexdigest()
+    memo = st.session_state.get("portfolio_upload")
+    if memo is None or memo[0] != digest:
+        memo = (digest, parse_portfolio(data))
+        st.session_state["portfolio_upload"] = memo
+    return memo
+
+
+def portfolio_match(digest: str, raw_import: pd.DataFrame, hierarchy: dict, aliases: dict) -> dict:
+    """Candidats, options et indices sélectionnables de chaque ligne importée."""
+    key = (
+        digest,
+        dataset_version("df3_enriched"),
+        hashlib.sha256(json.dumps(sorted(aliases.items())).encode()).hexdigest(),
+    )
+    memo = st.session_state.get("portfolio_match")
+    if memo is not None and memo["key"] == key:
+        return memo
+
+    labels = raw_import["label_import"].tolist()
+    memo = {
+        "key":        key,
+        "candidates": match_portfolio(labels, hierarchy, aliases=aliases),
+        "options":    {},   # ligne → (options, indices sélectionnables), à la demande
+    }
+    st.session_state["portfolio_match"] = memo
+    return memo
+
+
+def portfolio_row_options(match: dict, i: int, label: str, hierarchy: dict) -> tuple:
+    """Options de la ligne i pour le mode une-liste-par-ligne, construites une fois."""
+    if i not in match["options"]:
+        opts = build_selectbox_options(match["candidates"][i], label, hierarchy)
+        # Options "séparateur" (col_filter = None et description commençant par ──) exclues
+        valid = [j for j, o in enumerate(opts) if not (o[0] is None and o[2].startswith("──"))]
+        match["options"][i] = (opts, valid)
+    return match["options"][i]
+
+
+# Colonnes de df3_enriched lues par les profils pondérés du portefeuille
+PORTFOLIO_COLUMNS = ["type_produit", "_smr_norm", "_roman", "_source_amr"]
+
+
+def build_portfolio(hierarchy: dict, resolved: pd.DataFrame) -> dict:
+    """
+    Jointure des entrées résolues (col_filter, val_filter, poids_norm) sur les
+    positions pré-indexées (hierarchy["lignes"]) du frame renvoyé avec la
+    hiérarchie par hierarchy_index() :
+      positions : lignes de ce frame, entrée par entrée, dans l'ordre du référentiel
+      entree    : indice de l'entrée résolue de chaque ligne
+      poids     : poids_norm de cette entrée
+    """
+    lignes = hierarchy["lignes"]
+    blocs = [
+        lignes[col].get(val, np.empty(0, dtype=np.int64))
+        for col, val in zip(resolved["col_filter"].tolist(), resolved["val_filter"].tolist())
+    ]
+    positions = np.concatenate(blocs) if blocs else np.empty(0, dtype=np.int64)
+    entree    = np.repeat(np.arange(len(blocs)), [len(b) for b in blocs])
+    return {
+        "positions": positions,
+        "entree":    entree,
+        "poids":     resolved["poids_norm"].to_numpy(dtype=float)[entree],
+    }
+
+
+def portfolio_frame(
+    df: pd.DataFrame,
+    portfolio: dict,
+    resolved: pd.DataFrame,
+    columns: list,
+) -> pd.DataFrame:
+    """Lignes du portefeuille (colonnes `columns`) + __poids_norm__ et __label__."""
+    frame = df[columns].take(portfolio["positions"]).reset_index(drop=True)
+    frame["__poids_norm__"] = portfolio["poids"]
+    frame["__label__"]      = resolved["label_import"].to_numpy()[portfolio["entree"]]
+    return frame
+
+
+def profile_matrices(portfolio_df: pd.DataFrame, resolved_list: list, specs: dict) -> dict:
+    """
+    Matrices entrée × niveau des profils du portefeuille, tous indicateurs en
+    un passage. specs : {nom: (masque des lignes, colonne du niveau, ordre)}.
+
+    Un seul comptage (indicateur, entité, niveau) donne les parts de chaque
+    entité (value_counts normalisé) ; renvoie par indicateur :
+      niveaux : niveaux dans l'ordre d'apparition de l'ancien calcul
+      parts   : matrice entrées résolues × niveaux (0 si absent)
+      present : l'entrée a-t-elle des lignes pour cet indicateur ?
+    Le profil d'un vecteur de poids w est w @ parts / w @ present.
+    """
+    labels = pd.Index(list(dict.fromkeys(r["label_import"] for r in resolved_list)), dtype=object)
+    ligne  = labels.get_indexer(pd.Index([r["label_import"] for r in resolved_list], dtype=object))
+    code   = labels.get_indexer(portfolio_df["__label__"].astype(object))
+
+    parts = []
+    for name, (mask, col, _) in specs.items():
+        m = np.asarray(mask, dtype=bool)
+        parts.append(pd.DataFrame({
+            "profil": name,
+            "label":  code[m],
+            "rang":   np.flatnonzero(m),
+            "niveau": portfolio_df[col].to_numpy(dtype=object)[m],
+        }))
+    long = pd.concat(parts, ignore_index=True)
+    lignes_par_entite = long.groupby(["profil", "label"]).indices   # NaN compris
+    comptes = (
+        long.dropna(subset=["niveau"])
+        .groupby(["profil", "label", "niveau"], sort=False)
+        .size()
+        .reset_index(name="n")
+    )
+
+    out = {}
+    for name, (_, col, _) in specs.items():
+        c = comptes[comptes["profil"] == name]
+        present = np.array([(name, l) in lignes_par_entite for l in range(len(labels))], dtype=bool)
+        c = c.assign(prop=c["n"] / c.groupby("label")["n"].transform("sum"))
+        # Ordre d'insertion de l'ancien dict : value_counts des entrées dans
+        # l'ordre, jusqu'à ce que tous les niveaux présents soient vus
+        # (une colonne catégorielle y ajoute ses catégories vides, à 0 %)
+        attendus, niveaux = set(c["niveau"]), {}
+        for l in dict.fromkeys(ligne[present[ligne]].tolist()):
+            if attendus.issubset(niveaux):
+                break
+            rangs = long["rang"].to_numpy()[lignes_par_entite[(name, l)]]
+            niveaux.update(dict.fromkeys(portfolio_df[col].iloc[rangs].value_counts().index))
+        niveaux = list(niveaux)
+        matrice = (
+            c.pivot(index="label", columns="niveau", values="prop")
+            .reindex(index=range(len(labels)), columns=niveaux)
+            .fillna(0.0)
+            .to_numpy()
+        )
+        out[name] = {"niveaux": niveaux, "parts": matrice[ligne], "present": present[ligne]}
+    return out
+
+
+def weighted_profiles(
+    portfolio_df: pd.DataFrame,
+    resolved_list: list,
+    specs: dict,
+    matrices: dict | None = None,
+) -> dict:
+    """
+    Profils pondérés du portefeuille (poids_norm) pour chaque indicateur de
+    specs : {nom: DataFrame Niveau | Pourcentage (%)}. Les lignes pondérées de
+    profile_matrices() sont cumulées dans l'ordre des entrées, ce qui
+    reproduit au bit près l'ancienne somme entrée par entrée.
+    """
+    poids = np.array([r["poids_norm"] for r in resolved_list], dtype=float)
+    if matrices is None:
+        matrices = profile_matrices(portfolio_df, resolved_list, specs)
+    out = {}
+    for name, (_, _, order) in specs.items():
+        m = matrices[name]
+        total_poids_effectif = np.cumsum(np.where(m["present"], poids, 0.0))[-1] if len(poids) else 0.0
+        if not m["niveaux"] or total_poids_effectif == 0:
+            out[name] = pd.DataFrame(columns=["Niveau", "Pourcentage (%)"])
+            continue
+        totals = np.cumsum(m["parts"] * poids[:, None], axis=0)[-1]
+
+        result = pd.DataFrame({
+            "Niveau":          m["niveaux"],
+            "Pourcentage (%)": totals / total_poids_effectif * 100,
+        })
+        order_map = {v: i for i, v in enumerate(order)}
+        result["_ord"] = result["Niveau"].map(lambda x: order_map.get(x, 999))
+        result = result.sort_values("_ord").drop(columns="_ord").reset_index(drop=True)
+        result["Pourcentage (%)"] = result["Pourcentage (%)"].round(2)
+        out[name] = result[result["Pourcentage (%)"] > 0]
+    return out
+
+
+# ── Scénarios what-if ────────────────────────────────────────────────────────
+# Un scénario est un vecteur de poids sur les entrées résolues ; k scénarios
+# forment une matrice k × entrées, évaluée d'un seul produit matriciel par
+# indicateur sur les matrices de profile_matrices().
+
+# Indicateurs de synthèse : (indicateur, niveaux cumulés)
+QUALITY_METRICS = {
+    "% SMR Important":   ("SMR",  ["Important"]),
+    "% ASMR I-II":       ("ASMR", ["I", "II"]),
+    "% SMR Insuffisant": ("SMR",  ["Insuffisant"]),
+}
+
+
+def scenario_profiles(matrices: dict, weights: np.ndarray) -> dict:
+    """
+    Profils (%) de k vecteurs de poids (matrice k × entrées, normalisés ou
+    non) : {indicateur: DataFrame k × niveaux}. Comme weighted_profiles(),
+    chaque profil est rapporté au poids des entrées présentes pour
+    l'indicateur ; NaN si aucune ne l'est.
+    """
+    W = np.atleast_2d(np.asarray(weights, dtype=float))
+    out = {}
+    for name, m in matrices.items():
+        totals = W @ m["parts"]
+        effectif = W @ m["present"].astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pct = totals / effectif[:, None] * 100
+        pct[effectif == 0] = np.nan
+        out[name] = pd.DataFrame(pct, columns=m["niveaux"])
+    return out
+
+
+def scenario_metrics(matrices: dict, weights: np.ndarray, names: list) -> pd.DataFrame:
+    """QUALITY_METRICS de chaque scénario, une ligne par scénario."""
+    profiles = scenario_profiles(matrices, weights)
+    table = pd.DataFrame(index=pd.Index(names, name="Scénario"))
+    for metric, (indicateur, niveaux) in QUALITY_METRICS.items():
+        prof = profiles[indicateur].reindex(columns=niveaux, fill_value=0.0)
+        table[metric] = prof.to_numpy().sum(axis=1)
+    return table
+
+
+def drop_one_scenarios(labels: list, poids: np.ndarray) -> tuple[list, np.ndarray]:
+    """Sensibilité : une ligne retirée par scénario, les autres gardent leurs poids relatifs."""
+    W = np.tile(poids, (len(poids), 1))
+    np.fill_diagonal(W, 0.0)
+    return [f"Sans {l}" for l in labels], W
+
+
+def rebalancing_grid(
+    labels: list, poids: np.ndarray, i: int, cibles: np.ndarray,
+) -> tuple[list, np.ndarray]:
+    """
+    Poids de la ligne i fixé à chaque valeur de `cibles` (fractions de 1),
+    les autres lignes se partagent le reste au prorata de leurs poids.
+    """
+    autres = poids.astype(float).copy()
+    autres[i] = 0.0
+    reste = autres.sum()
+    if reste == 0:
+        cibles = np.array([1.0])
+    W = np.outer(1 - cibles, autres / reste if reste else autres)
+    W[:, i] = cibles
+    return [f"{labels[i]} à {c:.0%}" for c in cibles], W
+
+
+def perturbed_scenarios(
+    poids: np.ndarray, n: int, sigma: float, seed: int = 0,
+) -> tuple[list, np.ndarray]:
+    """n tirages log-normaux autour des poids actuels (σ en échelle log), renormalisés."""
+    rng = np.random.default_rng(seed)
+    W = poids * np.exp(sigma * rng.standard_normal((n, len(poids))))
+    W /= W.sum(axis=1, keepdims=True)
+    return [f"Perturbation {j + 1}" for j in range(n)], W
+
+
+def imported_scenarios(data: bytes, labels: list) -> tuple[list, np.ndarray]:
+    """
+    Fichier Excel : colonne Titulaire(s) (labels importés) puis une colonne
+    de pondérations par scénario. Les lignes absentes du fichier pèsent 0.
+    ValueError avec un message affichable.
+    """
+    try:
+        grid = pd.read_excel(io.BytesIO(data))
+    except Exception as e:
+        raise ValueError(f"Impossible de lire le fichier : {e}") from e
+    grid.columns = [str(c).strip() for c in grid.columns]
+    if "Titulaire(s)" not in grid.columns or len(grid.columns) < 2:
+        raise ValueError("Attendu : une colonne Titulaire(s) puis une colonne par scénario.")
+    grid = grid.dropna(subset=["Titulaire(s)"]).drop_duplicates("Titulaire(s)", keep="last")
+    scen = [c for c in grid.columns if c != "Titulaire(s)"]
+    values = grid.set_index("Titulaire(s)")[scen].apply(pd.to_numeric, errors="coerce").fillna(0)
+    W = values.reindex(pd.Index(labels, dtype=object), fill_value=0).to_numpy(dtype=float).T
+    if (W < 0).any():
+        raise ValueError("Les pondérations doivent être positives ou nulles.")
+    if not (W.sum(axis=1) > 0).all():
+        raise ValueError("Chaque scénario doit porter sur au moins une ligne du portefeuille.")
+    return scen, W / W.sum(axis=1, keepdims=True)
+
+
+# ── Optimisation des pondérations ────────────────────────────────────────────
+# Frank-Wolfe sur {min ≤ w ≤ max, Σw = 1, rotation ≤ plafond} : à chaque pas,
+# un oracle linéaire exact (glouton sur des segments mesurés depuis les poids
+# importés) donne le sommet le plus favorable selon le gradient, puis une
+# recherche linéaire vectorisée choisit le pas.
+
+# Objectif : (sens, [(indicateur, niveaux cumulés)]) ; sens +1 = maximiser
+OPTIM_OBJECTIFS = {
+    "Maximiser SMR Important + ASMR I-II": (+1, [("SMR", ["Important"]), ("ASMR", ["I", "II"])]),
+    "Maximiser SMR Important":             (+1, [("SMR", ["Important"])]),
+    "Maximiser ASMR I-II":                 (+1, [("ASMR", ["I", "II"])]),
+    "Minimiser SMR Insuffisant":           (-1, [("SMR", ["Insuffisant"])]),
+}
+
+
+def _objective_terms(matrices: dict, termes: list) -> list:
+    """[(numérateur a, dénominateur p)] : part(w) = w @ a / w @ p, pour chaque terme."""
+    out = []
+    for indicateur, niveaux in termes:
+        m = matrices[indicateur]
+        cols = [k for k, n in enumerate(m["niveaux"]) if n in niveaux]
+        out.append((m["parts"][:, cols].sum(axis=1), m["present"].astype(float)))
+    return out
+
+
+def _objective(terms: list, W: np.ndarray) -> np.ndarray:
+    """Somme des parts (%) pour chaque ligne de W (k × entrées) ; 0 si dénominateur nul."""
+    total = np.zeros(len(W))
+    for a, p in terms:
+        den = W @ p
+        total += np.divide(W @ a, den, out=np.zeros_like(den), where=den > 0) * 100
+    return total
+
+
+def _gradient(terms: list, w: np.ndarray) -> np.ndarray:
+    g = np.zeros_like(w)
+    for a, p in terms:
+        den = w @ p
+        if den > 0:
+            g += (a - (w @ a) / den * p) / den * 100
+    return g
+
+
+def _greedy_fill(g: np.ndarray, capacite: np.ndarray, masse: float) -> np.ndarray:
+    """Répartit `masse` sur les capacités par g croissant (ordre stable à égalité)."""
+    ordre = np.argsort(g, kind="stable")
+    cap   = capacite[ordre]
+    x     = np.empty_like(cap)
+    x[ordre] = np.clip(masse - (np.cumsum(cap) - cap), 0.0, cap)
+    return x
+
+
+def _linear_oracle(g: np.ndarray, poids: np.ndarray, lo: np.ndarray, hi: np.ndarray,
+                   rotation_max: float) -> np.ndarray:
+    """
+    argmin g·s sur {lo ≤ s ≤ hi, Σs = 1, ½·Σ|s − poids| ≤ rotation_max}, exact.
+    Chaque ligne monte depuis lo d'abord vers poids (segment « retour », qui
+    réduit la rotation d'autant), puis au-delà (segment « écart », qui
+    l'augmente). Avec une masse t sur les retours, le mieux est de remplir
+    retours et écarts par g croissant : le coût est convexe en t et la rotation
+    impose t ≥ t_min. D'où le glouton sur tous les segments (retours d'abord à
+    g égal), relevé à t_min s'il place moins que t_min sur les retours.
+    """
+    pivot  = np.clip(poids, lo, hi)
+    retour = pivot - lo
+    ecart  = hi - pivot
+    masse  = 1 - lo.sum()
+    t_min  = (masse + np.abs(lo - poids).sum()) / 2 - rotation_max
+
+    n = len(g)
+    x = _greedy_fill(np.concatenate([g, g]), np.concatenate([retour, ecart]), masse)
+    x_retour, x_ecart = x[:n], x[n:]
+    if x_retour.sum() < t_min:
+        x_retour = _greedy_fill(g, retour, t_min)
+        x_ecart  = _greedy_fill(g, ecart, masse - t_min)
+    return lo + x_retour + x_ecart
+
+
+def optimize_weights(
+    matrices: dict,
+    poids: np.ndarray,
+    objectif: str,
+    bornes_min: np.ndarray,
+    bornes_max: np.ndarray,
+    rotation_max: float,
+    iterations: int = 200,
+) -> dict:
+    """
+    Pondérations optimales pour OPTIM_OBJECTIFS[objectif], sous contraintes :
+      bornes_min ≤ w ≤ bornes_max (fractions, par entrée), Σw = 1,
+      rotation ½·Σ|w − poids| ≤ rotation_max (poids = pondérations importées).
+    ValueError si les contraintes sont incompatibles. Renvoie poids, valeur
+    et valeur initiale de l'objectif (%), rotation, itérations et écart dual.
+    """
+    poids = np.asarray(poids, dtype=float)
+    lo = np.asarray(bornes_min, dtype=float)
+    hi = np.asarray(bornes_max, dtype=float)
+    if (lo < 0).any() or (lo > hi).any():
+        raise ValueError("Bornes invalides : il faut 0 ≤ min ≤ max pour chaque ligne.")
+    if lo.sum() > 1 + 1e-12 or hi.sum() < 1 - 1e-12:
+        raise ValueError(
+            f"Bornes incompatibles avec un total de 100 % "
+            f"(Σ min = {lo.sum():.1%}, Σ max = {hi.sum():.1%})."
+        )
+    sens, termes = OPTIM_OBJECTIFS[objectif]
+    terms = _objective_terms(matrices, termes)
+
+    # Rotation imposée par les seules bornes ; départ en un point qui l'atteint
+    # (oracle à gradient nul : retours vers les poids importés d'abord)
+    depart = np.clip(poids, lo, hi)
+    besoin = 1 - depart.sum()
+    rotation_min = (np.abs(poids - depart).sum() + abs(besoin)) / 2
+    if rotation_min > rotation_max + 1e-12:
+        raise ValueError(
+            f"Rotation maximale trop faible : respecter les bornes impose déjà "
+            f"{rotation_min:.1%} de rotation."
+        )
+    w, gap, k = _linear_oracle(np.zeros_like(poids), poids, lo, hi, rotation_max), 0.0, 0
+    pas = np.linspace(0.0, 1.0, 65)
+    for k in range(1, iterations + 1):
+        g = -sens * _gradient(terms, w)
+        s = _linear_oracle(g, poids, lo, hi, rotation_max)
+        d = s - w
+        gap = -(g @ d)
+        if gap <= 1e-9:
+            break
+        valeurs = _objective(terms, w + pas[:, None] * d)
+        gamma = pas[np.argmax(sens * valeurs)]
+        if gamma == 0:
+            break
+        w = w + gamma * d
+
+    w = np.clip(w, lo, hi)
+    w /= w.sum()
+    return {
+        "poids":      w,
+        "valeur":     float(_objective(terms, w[None, :])[0]),
+        "initiale":   float(_objective(terms, poids[None, :])[0]),
+        "rotation":   float(np.abs(w - poids).sum() / 2),
+        "iterations": k,
+        "ecart":      float(gap),
+    }
+
+
+def review_grid(
+    match_key: tuple,
+    labels: list,
+    poids: list,
+    candidates: list,
+    hierarchy: dict,
+    badge_map: dict,
+) -> list:
+    """
+    Revue groupée des correspondances : les lignes exactes ou mémorisées sont
+    repliées dans un tableau en lecture seule, les lignes approximatives ou non
+    trouvées sont éditées dans une seule grille dont la colonne Correspondance
+    partage la liste du référentiel (envoyée une fois, quelle que soit la
+    taille du portefeuille). Renvoie (col_filter, val_filter, défaut conservé ?)
+    par ligne, dans l'ordre de l'import. match_key : clé du matching
+    (cf. portfolio_match), qui identifie la grille.
+    """
+    defaults = [default_choice(c, l) for c, l in zip(candidates, labels)]
+    a_revoir = [i for i, c in enumerate(candidates) if c["match_type"] in ("fuzzy", "aucun")]
+    exacts   = sorted(set(range(len(labels))) - set(a_revoir))
+    choix_par_cible = hierarchy["choix_par_cible"]
+
+    if exacts:
+        with st.expander(f"✅ {len(exacts)} correspondance(s) exacte(s) ou mémorisée(s)"):
+            st.dataframe(
+                pd.DataFrame({
+                    "Importé":        [labels[i] for i in exacts],
+                    "Poids (%)":      [poids[i] for i in exacts],
+                    "Statut":         [badge_map.get(candidates[i]["match_type"], "") for i in exacts],
+                    "Entité retenue": [choix_par_cible[defaults[i]] for i in exacts],
+                }),
+                use_container_width=True, hide_index=True,
+            )
+            st.caption("Pour modifier une correspondance exacte, désactivez la revue groupée.")
+
+    choices = [(col, val, True) for col, val in defaults]
+    if not a_revoir:
+        return choices
+
+    def suggestions(c: dict) -> str:
+        scored = c.get("fuzzy_grp", []) + c.get("fuzzy_tit", [])
+        return ", ".join(f"{e} ({sc:.0%})" for e, sc in scored)
+
+    grid = pd.DataFrame({
+        "Importé":        [labels[i] for i in a_revoir],
+        "Poids (%)":      [poids[i] for i in a_revoir],
+        "Statut":         [badge_map.get(candidates[i]["match_type"], "") for i in a_revoir],
+        "Suggestions":    [suggestions(candidates[i]) for i in a_revoir],
+        "Correspondance": [choix_par_cible[defaults[i]] for i in a_revoir],
+    })
+    edited = st.data_editor(
+        grid,
+        column_config={
+            "Correspondance": st.column_config.SelectboxColumn(
+                "Correspondance",
+                options=list(hierarchy["choix"]),
+                required=True,
+                help="Groupe (🏢) ou filiale (🏭 — groupe) du référentiel, ou exclusion",
+            ),
+        },
+        disabled=["Importé", "Poids (%)", "Statut", "Suggestions"],
+        hide_index=True,
+        use_container_width=True,
+        # Éditions conservées par position de ligne : la grille change d'identité
+        # dès que le matching change (import, version de df3_enriched, alias)
+        key="revue_" + hashlib.sha256(json.dumps(match_key).encode()).hexdigest()[:16],
+    )
+    for i, choix in zip(a_revoir, edited["Correspondance"].tolist()):
+        col, val = hierarchy["choix"].get(choix, (None, None))
+        choices[i] = (col, val, (col, val) == defaults[i])
+    return choices
+
+
 def page_portefeuille():
     st.markdown('<div class="page-title">📁 Construction de Portefeuille</div>', unsafe_allow_html=True)
     st.markdown(
@@ -1137,26 +3285,21 @@ def page_portefeuille():
     )
 
     # ── Référentiel ────────────────────────────────────────────────────────────
-    ref = (
-        df3_enriched[["Titulaire(s)", "groupe_racine"]]
-        .dropna(subset=["Titulaire(s)", "groupe_racine"])
-        .drop_duplicates()
-    )
-    all_titulaires  = sorted(ref["Titulaire(s)"].unique())
-    all_groupes     = sorted(ref["groupe_racine"].unique())
-    set_titulaires  = set(all_titulaires)
-    set_groupes     = set(all_groupes)
+    # Les positions de hierarchy["lignes"] se rapportent à ce frame-là, même si
+    # le rafraîchissement en arrière-plan publie une nouvelle version entre-temps
+    df3_enriched, hierarchy = hierarchy_index()
 
     # ── 1. Import Excel ────────────────────────────────────────────────────────
     section_header("1️⃣ Import du fichier de pondérations")
 
-    template_buf = io.BytesIO()
-    with pd.ExcelWriter(template_buf, engine="openpyxl") as writer:
-        pd.DataFrame({
-            "Titulaire(s)": ["Exemple Pharma SA", "Autre Biotech"],
-            "Pondérations":  [60.0, 40.0],
-        }).to_excel(writer, index=False)
-    template_buf.seek(0)
+    def template_bytes() -> bytes:
+        template_buf = io.BytesIO()
+        with pd.ExcelWriter(template_buf, engine="openpyxl") as writer:
+            pd.DataFrame({
+                "Titulaire(s)": ["Exemple Pharma SA", "Autre Biotech"],
+                "Pondérations":  [60.0, 40.0],
+            }).to_excel(writer, index=False)
+        return template_buf.getvalue()
 
     st.caption(
         "Format attendu : deux colonnes — **Titulaire(s)** et **Pondérations** "
@@ -1164,7 +3307,7 @@ def page_portefeuille():
     )
     st.download_button(
         "📥 Télécharger le template Excel",
-        data=template_buf,
+        data=template_bytes,
         file_name="template_pondérations.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )
@@ -1180,34 +3323,9 @@ def page_portefeuille():
         st.stop()
 
     try:
-        import openpyxl as _openpyxl
-        _wb = _openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
-        _ws = _wb.active
-        _rows = list(_ws.iter_rows(values_only=True))
-        _wb.close()
-        if not _rows or len(_rows) < 2:
-            st.error("❌ Le fichier est vide ou ne contient qu'une ligne d'en-tête.")
-            st.stop()
-        _headers = [str(c).strip() if c is not None else "" for c in _rows[0]]
-        raw_import = pd.DataFrame(_rows[1:], columns=_headers)
-    except Exception as e:
-        st.error(f"❌ Impossible de lire le fichier : {e}")
-        st.stop()
-
-    if not {"Titulaire(s)", "Pondérations"}.issubset(set(raw_import.columns)):
-        st.error(
-            f"❌ Colonnes trouvées : `{raw_import.columns.tolist()}` — "
-            "attendu : Titulaire(s) et Pondérations"
-        )
-        st.stop()
-
-    raw_import = raw_import[["Titulaire(s)", "Pondérations"]].dropna()
-    raw_import.columns = ["label_import", "poids"]
-    raw_import["poids"] = pd.to_numeric(raw_import["poids"], errors="coerce").fillna(0)
-    raw_import = raw_import[raw_import["poids"] > 0].reset_index(drop=True)
-
-    if raw_import.empty:
-        st.error("❌ Aucune pondération > 0 trouvée dans le fichier.")
+        digest, raw_import = portfolio_upload(uploaded_file.getvalue())
+    except ValueError as e:
+        st.error(f"❌ {e}")
         st.stop()
 
     # ── 2. Tableau de correspondance ───────────────────────────────────────────
@@ -1219,48 +3337,95 @@ def page_portefeuille():
         "sont proposées pour une sélection manuelle."
     )
 
+    # Alias mémorisés : import / export avant le matching, pour qu'un import
+    # serve dès ce passage
+    with st.expander("📌 Alias mémorisés"):
+        alias_file = st.file_uploader(
+            "Importer un export d'alias (JSON)", type=["json"], key="alias_import",
+        )
+        # Import une seule fois par fichier : tant qu'il reste attaché, les
+        # reruns ne doivent pas écraser les décisions mémorisées depuis
+        alias_data = alias_file.getvalue() if alias_file is not None else None
+        alias_digest = hashlib.sha256(alias_data).hexdigest() if alias_data is not None else None
+        if alias_digest is not None and alias_digest != st.session_state.get("alias_import_digest"):
+            try:
+                n = import_aliases(alias_data)
+                st.session_state["alias_import_digest"] = alias_digest
+                st.success(f"✅ {n} alias importé(s).")
+            except (ValueError, sqlite3.Error) as e:
+                st.error(f"❌ Import impossible : {e}")
+        aliases = load_aliases()
+        st.caption(
+            f"{len(aliases)} correspondance(s) confirmée(s) — résolues sans matching "
+            "tant que leur cible existe dans le référentiel."
+        )
+        st.download_button(
+            "📥 Exporter les alias (JSON)",
+            data=export_aliases,
+            file_name="alias_portefeuille.json",
+            mime="application/json",
+            disabled=not aliases,
+        )
+
     resolved       = []
     unknown_labels = []
     fuzzy_labels   = []
+    decisions      = []
+
+    # Matching mémorisé dans la session ; un import d'alias ci-dessus change
+    # la clé et relance le matching
+    match = portfolio_match(digest, raw_import, hierarchy, aliases)
+
+    labels     = raw_import["label_import"].tolist()
+    poids_list = raw_import["poids"].tolist()
+    candidates = match["candidates"]
+    badge_map = {
+        "alias":     "📌 alias mémorisé",
+        "exact_tit": "✅ titulaire exact",
+        "exact_grp": "✅ groupe exact",
+        "fuzzy":     "🔶 approximatif",
+        "aucun":     "❌ non trouvé",
+    }
 
-    for _, row in raw_import.iterrows():
-        label = row["label_import"]
-        poids = row["poids"]
-
-        c    = find_candidates(label, ref, set_titulaires, set_groupes, all_groupes)
-        opts = build_selectbox_options(c, label, ref, all_groupes)
+    revue_groupee = st.toggle(
+        "Revue groupée",
+        value=True,
+        help="Une seule grille pour les lignes approximatives ou non trouvées, avec un "
+             "sélecteur de référentiel partagé. Désactiver pour une liste par ligne.",
+    )
 
-        badge_map = {
-            "exact_tit": "✅ titulaire exact",
-            "exact_grp": "✅ groupe exact",
-            "fuzzy":     "🔶 approximatif",
-            "aucun":     "❌ non trouvé",
-        }
-        badge = badge_map.get(c["match_type"], "")
+    # (col_filter, val_filter, choix par défaut conservé ?) pour chaque ligne
+    choices = []
+    if revue_groupee:
+        choices = review_grid(match["key"], labels, poids_list, candidates, hierarchy, badge_map)
+    else:
+        for i, (label, poids, c) in enumerate(zip(labels, poids_list, candidates)):
+            opts, valid_indices = portfolio_row_options(match, i, label, hierarchy)
+            col_lbl, col_sel = st.columns([2, 4])
+            with col_lbl:
+                st.markdown(f"**{label}** &nbsp; `{poids}%` &nbsp; {badge_map.get(c['match_type'], '')}")
+            with col_sel:
+                chosen_idx = st.selectbox(
+                    label=f"sel_{label}",
+                    options=valid_indices,
+                    format_func=lambda i, o=opts: o[i][2],
+                    key=f"sel_{label}",
+                    label_visibility="collapsed",
+                )
+            col_filter, val_filter, _ = opts[chosen_idx]
+            choices.append((col_filter, val_filter, chosen_idx == valid_indices[0]))
 
+    for label, poids, c, (col_filter, val_filter, is_default) in zip(
+        labels, poids_list, candidates, choices,
+    ):
         if c["match_type"] == "fuzzy":
             fuzzy_labels.append(label)
         if c["match_type"] == "aucun":
             unknown_labels.append(label)
 
-        col_lbl, col_sel = st.columns([2, 4])
-        with col_lbl:
-            st.markdown(f"**{label}** &nbsp; `{poids}%` &nbsp; {badge}")
-        with col_sel:
-            # Désactiver les options "séparateur" (col_filter = None et description commence par ──)
-            valid_indices = [
-                i for i, o in enumerate(opts)
-                if not (o[0] is None and o[2].startswith("──"))
-            ]
-            chosen_idx = st.selectbox(
-                label=f"sel_{label}",
-                options=valid_indices,
-                format_func=lambda i, o=opts: o[i][2],
-                key=f"sel_{label}",
-                label_visibility="collapsed",
-            )
-
-        col_filter, val_filter, _ = opts[chosen_idx]
+        # Un match exact conservé tel quel se résout déjà sans effort
+        if not (c["match_type"] in ("exact_tit", "exact_grp") and is_default):
+            decisions.append((label, col_filter, val_filter))
 
         if col_filter is None:
             if label not in unknown_labels:
@@ -1275,6 +3440,16 @@ def page_portefeuille():
             "match_type":   c["match_type"],
         })
 
+    if st.button(
+        "💾 Mémoriser ces correspondances",
+        help="Les prochains imports résoudront ces labels directement (alias).",
+    ):
+        try:
+            n = save_aliases(decisions)
+            st.success(f"✅ {n} correspondance(s) mémorisée(s).")
+        except sqlite3.Error as e:
+            st.error(f"❌ Enregistrement impossible : {e}")
+
     # Rapport de couverture
     nb_importes = len(raw_import)
     nb_resolus  = len(resolved)
@@ -1330,31 +3505,16 @@ def page_portefeuille():
     st.dataframe(recap_display, use_container_width=True, hide_index=True)
 
     # ── 4. Construction du sous-dataframe portefeuille ─────────────────────────
-    @st.cache_data(show_spinner=False)
-    def build_portfolio(_df: pd.DataFrame, resolved_json: str) -> pd.DataFrame:
-        """Cache stable : on sérialise resolved_list en JSON pour éviter
-        les instabilités de hash sur les listes de dicts avec des floats."""
-        import json
-        resolved_list = json.loads(resolved_json)
-        frames = []
-        for r in resolved_list:
-            sub = _df[_df[r["col_filter"]] == r["val_filter"]].copy()
-            sub["__poids_norm__"] = r["poids_norm"]
-            sub["__label__"]      = r["label_import"]
-            frames.append(sub)
-        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
-
-    import json
-    resolved_list = resolved_df.to_dict("records")
-    portfolio_df  = build_portfolio(
-        df3_enriched,
-        json.dumps(resolved_list, ensure_ascii=False, default=str),
-    )
-
-    if portfolio_df.empty:
+    # Jointure sur les clés indexées : positions + poids, sans recopier les
+    # lignes du référentiel ; seules les colonnes utiles aux profils sont lues.
+    portfolio = build_portfolio(hierarchy, resolved_df)
+    if not len(portfolio["positions"]):
         st.error("❌ Aucun produit trouvé pour ce portefeuille.")
         st.stop()
 
+    resolved_list = resolved_df.to_dict("records")
+    portfolio_df  = portfolio_frame(df3_enriched, portfolio, resolved_df, PORTFOLIO_COLUMNS)
+
     meds = portfolio_df[portfolio_df["type_produit"] == "medicament"]
     dms  = portfolio_df[portfolio_df["type_produit"] == "dispositif_medical"]
     pct_meds = len(meds) / len(portfolio_df) * 100
@@ -1369,35 +3529,22 @@ def page_portefeuille():
     with c4: kpi_card("Entités retenues", len(resolved_df))
 
     # ── 5. Calcul des profils pondérés ─────────────────────────────────────────
-    def weighted_profile(sub_portfolio: pd.DataFrame, col: str,
-                         order: list, r_list: list) -> pd.DataFrame:
-        totals = {}
-        total_poids_effectif = 0.0
-        for r in r_list:
-            sub = sub_portfolio[sub_portfolio["__label__"] == r["label_import"]]
-            if sub.empty:
-                continue
-            poids = r["poids_norm"]
-            total_poids_effectif += poids
-            counts = sub[col].value_counts(normalize=True)
-            for val, prop in counts.items():
-                totals[val] = totals.get(val, 0) + prop * poids
-
-        if not totals or total_poids_effectif == 0:
-            return pd.DataFrame(columns=["Niveau", "Pourcentage (%)"])
-
-        result = pd.DataFrame(
-            [(k, v / total_poids_effectif * 100) for k, v in totals.items()],
-            columns=["Niveau", "Pourcentage (%)"],
-        )
-        order_map = {v: i for i, v in enumerate(order)}
-        result["_ord"] = result["Niveau"].map(lambda x: order_map.get(x, 999))
-        result = result.sort_values("_ord").drop(columns="_ord").reset_index(drop=True)
-        result["Pourcentage (%)"] = result["Pourcentage (%)"].round(2)
-        return result[result["Pourcentage (%)"] > 0]
+    meds_asmr = portfolio_df[portfolio_df["_source_amr"] == "ASMR"]
+    dms_asr   = portfolio_df[portfolio_df["_source_amr"] == "ASR"]
+
+    profile_specs = {
+        "SMR":  (portfolio_df["type_produit"] == "medicament",         "_smr_norm", SMR_ORDER),
+        "SR":   (portfolio_df["type_produit"] == "dispositif_medical", "_smr_norm", SR_ORDER),
+        "ASMR": (portfolio_df["_source_amr"] == "ASMR",                "_roman",    ASMR_ORDER),
+        "ASR":  (portfolio_df["_source_amr"] == "ASR",                 "_roman",    ASR_ORDER),
+    }
+    matrices = profile_matrices(portfolio_df, resolved_list, profile_specs)
+    profiles = weighted_profiles(portfolio_df, resolved_list, profile_specs, matrices)
 
     def make_pie(df_profile: pd.DataFrame, colors_map: dict, title: str,
                  legend_map=None, height: int = 380):
+        import plotly.express as px
+
         if df_profile is None or df_profile.empty:
             st.info("Aucune donnée disponible pour ce graphique.")
             return
@@ -1428,8 +3575,8 @@ def page_portefeuille():
         "utilisent la même échelle qualitative mais s'appliquent à des populations distinctes."
     )
 
-    smr_profile = weighted_profile(meds, "_smr_norm", SMR_ORDER, resolved_list)
-    sr_profile  = weighted_profile(dms,  "_smr_norm", SR_ORDER,  resolved_list)
+    smr_profile = profiles["SMR"]
+    sr_profile  = profiles["SR"]
 
     col_smr, col_sr = st.columns(2, gap="large")
     with col_smr:
@@ -1462,11 +3609,8 @@ def page_portefeuille():
         "les valeurs courtes (`I`…`V`) sont attribuées selon le `type_produit`."
     )
 
-    meds_asmr = portfolio_df[portfolio_df["_source_amr"] == "ASMR"]
-    dms_asr   = portfolio_df[portfolio_df["_source_amr"] == "ASR"]
-
-    asmr_profile = weighted_profile(meds_asmr, "_roman", ASMR_ORDER, resolved_list)
-    asr_profile  = weighted_profile(dms_asr,   "_roman", ASR_ORDER,  resolved_list)
+    asmr_profile = profiles["ASMR"]
+    asr_profile  = profiles["ASR"]
 
     col_asmr, col_asr = st.columns(2, gap="large")
     with col_asmr:
@@ -1521,12 +3665,12 @@ def page_portefeuille():
         return buf.read()
 
     col_dl1, col_dl2, col_dl3, _ = st.columns([1, 1, 1, 1])
-    export_cols = [c for c in portfolio_df.columns if not c.startswith("__") and not c.startswith("_")]
+    export_cols = [c for c in df3_enriched.columns if not c.startswith("_")]
 
     with col_dl1:
         st.download_button(
             "📥 Portefeuille complet (Excel)",
-            data=export_excel(portfolio_df[export_cols]),
+            data=lambda: export_excel(portfolio_frame(df3_enriched, portfolio, resolved_df, export_cols)),
             file_name=f"portefeuille_{datetime.now().date()}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True,
@@ -1534,7 +3678,7 @@ def page_portefeuille():
     with col_dl2:
         st.download_button(
             "📥 Profils SMR/SR/ASMR/ASR (Excel)",
-            data=profiles_to_excel(smr_profile, sr_profile, asmr_profile, asr_profile, ASMR_LEGEND),
+            data=lambda: profiles_to_excel(smr_profile, sr_profile, asmr_profile, asr_profile, ASMR_LEGEND),
             file_name=f"profils_qualite_{datetime.now().date()}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True,
@@ -1542,12 +3686,186 @@ def page_portefeuille():
     with col_dl3:
         st.download_button(
             "📥 Correspondances retenues (Excel)",
-            data=export_excel(recap_display),
+            data=lambda: export_excel(recap_display),
             file_name=f"correspondances_{datetime.now().date()}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True,
         )
 
+    # ── 9. Scénarios what-if ───────────────────────────────────────────────────
+    st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+    section_header("7️⃣ Scénarios what-if")
+    st.caption(
+        "Évaluez d'un coup des centaines de pondérations alternatives sur les mêmes lignes "
+        "(sans réimporter le fichier) : chaque scénario est comparé au portefeuille importé."
+    )
+
+    scen_labels = [r["label_import"] for r in resolved_list]
+    poids_actuels = resolved_df["poids_norm"].to_numpy(dtype=float)
+
+    mode = st.radio(
+        "Type de scénarios",
+        ["Retrait d'une ligne", "Grille de rééquilibrage", "Perturbations aléatoires",
+         "Pondérations importées"],
+        horizontal=True,
+        key="scenario_mode",
+    )
+    names, W = [], np.empty((0, len(scen_labels)))
+    if mode == "Retrait d'une ligne":
+        names, W = drop_one_scenarios(scen_labels, poids_actuels)
+    elif mode == "Grille de rééquilibrage":
+        g1, g2, g3 = st.columns([2, 1, 1])
+        with g1:
+            i = st.selectbox("Ligne à rééquilibrer", range(len(scen_labels)),
+                             format_func=scen_labels.__getitem__, key="scenario_ligne")
+        with g2:
+            poids_max = st.slider("Poids max (%)", 5, 100, 50, step=5, key="scenario_max")
+        with g3:
+            pas = st.slider("Nombre de pas", 3, 101, 11, key="scenario_pas")
+        names, W = rebalancing_grid(scen_labels, poids_actuels, i,
+                                    np.linspace(0, poids_max / 100, pas))
+    elif mode == "Perturbations aléatoires":
+        p1, p2, p3 = st.columns(3)
+        with p1:
+            n_scen = st.number_input("Nombre de scénarios", 10, 20000, 1000, step=100,
+                                     key="scenario_n")
+        with p2:
+            sigma = st.slider("Amplitude (σ log-normal)", 0.05, 1.0, 0.25, step=0.05,
+                              key="scenario_sigma")
+        with p3:
+            seed = st.number_input("Graine", 0, 10**6, 0, key="scenario_seed")
+        names, W = perturbed_scenarios(poids_actuels, int(n_scen), sigma, int(seed))
+    else:
+        st.caption("Fichier Excel : colonne **Titulaire(s)** (labels importés) puis une colonne "
+                   "de pondérations par scénario.")
+        scen_file = st.file_uploader("Importer les scénarios", type=["xlsx"], key="scenario_file")
+        if scen_file is not None:
+            try:
+                names, W = imported_scenarios(scen_file.getvalue(), scen_labels)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+
+    if names:
+        table = pd.concat([
+            scenario_metrics(matrices, poids_actuels, ["Portefeuille importé"]),
+            scenario_metrics(matrices, W, names),
+        ])
+        for metric in QUALITY_METRICS:
+            table[f"Δ {metric} (pts)"] = table[metric] - table[metric].iloc[0]
+        st.dataframe(
+            table.reset_index(),
+            column_config={
+                c: st.column_config.NumberColumn(format="%+.2f" if c.startswith("Δ") else "%.2f")
+                for c in table.columns
+            },
+            use_container_width=True,
+            hide_index=True,
+        )
+
+        def scenarios_to_excel() -> bytes:
+            buf = io.BytesIO()
+            with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+                pd.DataFrame(W, index=pd.Index(names, name="Scénario"),
+                             columns=scen_labels).to_excel(writer, sheet_name="Poids")
+                for name, prof in scenario_profiles(matrices, W).items():
+                    prof.index = pd.Index(names, name="Scénario")
+                    prof.to_excel(writer, sheet_name=name)
+            return buf.getvalue()
+
+        st.download_button(
+            f"📥 Profils des {len(names)} scénarios (Excel)",
+            data=scenarios_to_excel,
+            file_name=f"scenarios_{datetime.now().date()}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+    # ── 10. Optimisation des pondérations ──────────────────────────────────────
+    st.markdown("<hr class='thin'>", unsafe_allow_html=True)
+    section_header("8️⃣ Optimisation des pondérations")
+    st.caption(
+        "Cherche les pondérations qui maximisent (ou minimisent) la part qualitative choisie, "
+        "avec des bornes par ligne et une rotation maximale depuis les pondérations importées "
+        "(rotation = ½ Σ |poids optimisé − poids importé|)."
+    )
+
+    o1, o2, o3, o4 = st.columns([2, 1, 1, 1])
+    with o1:
+        objectif = st.selectbox("Objectif", list(OPTIM_OBJECTIFS), key="optim_objectif")
+    with o2:
+        min_global = st.number_input("Min par ligne (%)", 0.0, 100.0, 0.0, step=0.5, key="optim_min")
+    with o3:
+        max_global = st.number_input("Max par ligne (%)", 0.0, 100.0, 100.0, step=0.5, key="optim_max")
+    with o4:
+        rotation_max = st.slider("Rotation max (%)", 0, 100, 20, key="optim_rotation")
+
+    with st.expander("Bornes par ligne"):
+        bornes = st.data_editor(
+            pd.DataFrame({
+                "Importé":              scen_labels,
+                "Poids importé (%)":    (poids_actuels * 100).round(2),
+                "Min (%)":              min_global,
+                "Max (%)":              max_global,
+            }),
+            column_config={
+                "Min (%)": st.column_config.NumberColumn(min_value=0.0, max_value=100.0),
+                "Max (%)": st.column_config.NumberColumn(min_value=0.0, max_value=100.0),
+            },
+            disabled=["Importé", "Poids importé (%)"],
+            hide_index=True,
+            use_container_width=True,
+            key=f"optim_bornes_{digest[:16]}_{min_global}_{max_global}",
+        )
+
+    try:
+        optim = optimize_weights(
+            matrices, poids_actuels, objectif,
+            bornes["Min (%)"].fillna(min_global).to_numpy(dtype=float) / 100,
+            bornes["Max (%)"].fillna(max_global).to_numpy(dtype=float) / 100,
+            rotation_max / 100,
+        )
+    except ValueError as e:
+        st.error(f"❌ {e}")
+    else:
+        r1, r2, r3 = st.columns(3)
+        with r1: kpi_card("Objectif — importé",  f"{optim['initiale']:.2f}%")
+        with r2: kpi_card("Objectif — optimisé", f"{optim['valeur']:.2f}%")
+        with r3: kpi_card("Rotation",            f"{optim['rotation']:.1%}")
+
+        optim_df = pd.DataFrame({
+            "Importé":             scen_labels,
+            "Poids importé (%)":   poids_actuels * 100,
+            "Poids optimisé (%)":  optim["poids"] * 100,
+        })
+        optim_df["Δ (pts)"] = optim_df["Poids optimisé (%)"] - optim_df["Poids importé (%)"]
+        st.dataframe(
+            pd.concat([
+                scenario_metrics(matrices, poids_actuels, ["Portefeuille importé"]),
+                scenario_metrics(matrices, optim["poids"], ["Portefeuille optimisé"]),
+            ]).reset_index(),
+            column_config={m: st.column_config.NumberColumn(format="%.2f") for m in QUALITY_METRICS},
+            use_container_width=True,
+            hide_index=True,
+        )
+        st.dataframe(
+            optim_df.sort_values("Δ (pts)", key=abs, ascending=False),
+            column_config={
+                c: st.column_config.NumberColumn(format="%+.2f" if c.startswith("Δ") else "%.2f")
+                for c in optim_df.columns if c != "Importé"
+            },
+            use_container_width=True,
+            hide_index=True,
+        )
+        # Même format que le fichier importé : réimportable tel quel
+        st.download_button(
+            "📥 Pondérations optimisées (Excel)",
+            data=lambda: export_excel(pd.DataFrame({
+                "Titulaire(s)": scen_labels,
+                "Pondérations": (optim["poids"] * 100).round(4),
+            })),
+            file_name=f"ponderations_optimisees_{datetime.now().date()}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 # 14.  ROUTEUR PRINCIPAL
@@ -1559,4 +3877,45 @@ PAGES = {
     "📁  Portefeuille":        page_portefeuille,
 }
 
+# Datasets dont chaque page a besoin : une source en échec ne bloque que
+# les pages qui en dépendent.
+PAGE_DATASETS = {
+    "🔎  Recherche Produit":   ["df", "df2"],
+    "🏢  Analyse Laboratoire": ["df3_enriched", "group_kpis", "group_cube", "group_leaderboard"],
+    "💰  Chiffre d'Affaires":  ["df1"],
+    "📁  Portefeuille":        ["df3_enriched"],
+}
+
+start_refresher(data_store())
+with st.spinner("Chargement des données…"):
+    _frames, LOAD_TIMINGS, LOAD_ERRORS = load_datasets(PAGE_DATASETS[page])
+_run_frames.update(_frames)
+
+with st.sidebar:
+    with st.expander("⏱️ Chargement des données"):
+        for name in PAGE_DATASETS[page]:
+            if name in LOAD_ERRORS:
+                st.markdown(f"❌ `{name}` — indisponible")
+            else:
+                st.markdown(f"✅ `{name}` — {LOAD_TIMINGS[name] * 1000:.0f} ms")
+        _bundle = bundle_manifest()
+        if _bundle:
+            st.caption(f"Bundle `{_bundle['build_id']}` (construit le {_bundle['built_at']}).")
+        if REFRESH_INTERVAL > 0:
+            st.caption(f"Sources revalidées toutes les {REFRESH_INTERVAL // 60} min.")
+    with st.expander("🧠 Mémoire résidente"):
+        st.dataframe(frame_memory_report(data_store()), hide_index=True)
+        st.caption("Mode compact actif." if COMPACT_MEMORY
+                   else "Mode compact inactif (DEFIS_COMPACT_MEMORY=1).")
+        if st.button("📏 Mesurer le gain vs st.cache_data", use_container_width=True):
+            st.dataframe(cache_copy_report(data_store()), hide_index=True)
+
+_missing = [name for name in PAGE_DATASETS[page] if name in LOAD_ERRORS]
+if _missing:
+    st.error(
+        "❌ Données indisponibles pour cette page : "
+        + ", ".join(f"`{name}` ({LOAD_ERRORS[name]})" for name in _missing)
+    )
+    st.stop()
+
 PAGES[page]()
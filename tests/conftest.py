@@ -0,0 +1,30 @@
+"""
+Chargement de DEFI6.py pour les tests.
+
+Le script exécute toute l'application à l'import : on n'évalue que les
+sections 0 à 13 (constantes, utilitaires, chargement, normalisation,
+matching, pages), sans le routeur final qui affiche la page choisie.
+"""
+import os
+import tempfile
+import types
+from pathlib import Path
+
+import pytest
+
+APP = Path(__file__).resolve().parent.parent / "DEFI6.py"
+ROUTER_BANNER = "# 14.  ROUTEUR PRINCIPAL"
+
+
+@pytest.fixture(scope="session")
+def app():
+    tmp = Path(tempfile.mkdtemp(prefix="defi6-tests-"))
+    os.environ.setdefault("DEFIS_SNAPSHOT_DIR", str(tmp / "snapshots"))
+    os.environ.setdefault("DEFIS_ALIAS_DB", str(tmp / "aliases.sqlite"))
+
+    source = APP.read_text(encoding="utf-8")
+    cut = source.rindex("\n# ═", 0, source.index(ROUTER_BANNER))
+    module = types.ModuleType("defi6")
+    module.__file__ = str(APP)
+    exec(compile(source[:cut], str(APP), "exec"), module.__dict__)
+    return module
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+
+def test_compact_frame_keeps_all_nan_columns(app):
+    df = pd.DataFrame({
+        "Titulaire(s)":  ["A", "B", "A"],
+        "Revenue_USD":   [np.nan] * 3,
+        app.ASMR_COL:    pd.Series([np.nan] * 3, dtype=object),
+        "n":             [1, 2, 3],
+    })
+    out = app.compact_frame(df, app.CATEGORICAL_COLUMNS)
+    assert list(out.columns) == list(df.columns)
+    assert out["Revenue_USD"].isna().all()
+    assert pd.api.types.is_float_dtype(out["Revenue_USD"])
+    assert out["Revenue_USD"].sum() == 0
+    assert isinstance(out[app.ASMR_COL].dtype, pd.CategoricalDtype)
+    assert out[app.ASMR_COL].isna().all()
+
+
+def test_compact_frame_same_values(app):
+    df = pd.DataFrame({"x": [1.5, 2.0, np.nan], "t": ["a", "a", "b"], "n": [1, 2, 300]})
+    out = app.compact_frame(df)
+    pd.testing.assert_frame_equal(out.astype(object), df.astype(object), check_dtype=False)
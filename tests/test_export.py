@@ -0,0 +1,23 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+
+@pytest.mark.parametrize("dtype", [object, "str", "category"])
+def test_clean_illegal_characters(app, dtype):
+    df = pd.DataFrame({"nom": ["AB\x01C", "D\x7fE"], "n": [1, 2]})
+    df["nom"] = df["nom"].astype(dtype)
+    out = app.clean_illegal_characters(df)
+    assert out["nom"].tolist() == ["ABC", "DE"]
+    assert out["n"].tolist() == [1, 2]
+
+
+def test_export_excel_arrow_strings(app):
+    df = app.to_arrow_strings(pd.DataFrame({"nom": ["AB\x01C", "OK"], "x": [1.5, np.nan]}))
+    data = app.export_excel(df)
+    rows = list(load_workbook(io.BytesIO(data)).active.values)
+    assert rows[1][0] == "ABC"
+    assert rows[2][0] == "OK"
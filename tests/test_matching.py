@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+PAIRS = [
+    ("LABORATOIRES SERVIER",   "SERVIER"),
+    ("SERVIER MONDE",          "SERVIER"),
+    ("PFIZER HOLDING FRANCE",  "PFIZER"),
+    ("PFIZER PFE FRANCE",      "PFIZER"),
+    ("NOVO NORDISK A/S",       "NOVO NORDISK"),
+    ("ROCHE",                  "ROCHE"),
+    ("ROCHE",                  "ROCHE DIAGNOSTICS"),     # titulaire à deux groupes
+    *[(f"ALPHA BIO {s}", f"ALPHA {n}") for n, s in zip(
+        ("ONE", "TWO", "SIX", "TEN", "SUN", "SKY", "SEA"),
+        ("LABS", "PHARMA", "SAS", "GMBH", "LTD", "INC", "CORP"),
+    )],
+]
+
+LABELS = [
+    "LABORATOIRES SERVIER",          # exact titulaire
+    "PFIZER",                        # exact groupe
+    "ROCHE",                         # titulaire et groupe : le titulaire l'emporte
+    "Laboratoires Pfizer",           # fuzzy (Jaccard 1.0 sur le groupe)
+    "Novo-Nordisk SA",               # fuzzy, plusieurs jetons
+    "Alpha Bio",                     # fuzzy, 7 titulaires à égalité (top 5)
+    "Servier Biotech",               # Jaccard 0.5 < SEUIL_FUZZY → aucun
+    "Laboratoires",                  # aucun jeton significatif
+    "Unknown Corp",                  # aucun
+    "PFIZER",                        # doublons
+    "Laboratoires Pfizer",
+    "Servier Biotech",
+]
+
+
+@pytest.fixture
+def hierarchy(app):
+    df = pd.DataFrame(PAIRS * 2, columns=["Titulaire(s)", "groupe_racine"])
+    return app.build_hierarchy(df)
+
+
+def test_match_portfolio_follows_find_candidates(app, hierarchy):
+    assert app.match_portfolio(LABELS, hierarchy) == [
+        app.find_candidates(label, hierarchy) for label in LABELS
+    ]
+
+
+def test_fixture_covers_every_step(app, hierarchy):
+    types = [c["match_type"] for c in app.match_portfolio(LABELS, hierarchy)]
+    assert types[:9] == [
+        "exact_tit", "exact_grp", "exact_tit", "fuzzy", "fuzzy", "fuzzy",
+        "aucun", "aucun", "aucun",
+    ]
+    alpha = app.find_candidates("Alpha Bio", hierarchy)
+    assert [t for t, _ in alpha["fuzzy_tit"]] == [
+        "ALPHA BIO LABS", "ALPHA BIO PHARMA", "ALPHA BIO SAS", "ALPHA BIO GMBH", "ALPHA BIO LTD",
+    ]
+    assert app.token_jaccard("Servier Biotech", "SERVIER") < app.SEUIL_FUZZY
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def asmr_values(app):
+    roman = list(app.ROMAN_TO_LABEL)
+    return [
+        *roman, *[f" {r} " for r in roman],
+        *[f"{r}. Amélioration" for r in roman], "VI. Autre", "IIV. Autre",
+        "Commentaires", "commentaire libre", "Voir COMMENTAIRE",
+        "Non précisé", "", "   ", "VII", "i", 3, np.nan, None,
+    ]
+
+
+@pytest.fixture
+def smr_values(app):
+    return [
+        *app.SMR_NORM, *[f"  {v}  " for v in app.SMR_NORM],
+        "important", "Inconnu", "", 1, np.nan, None,
+    ]
+
+
+def test_normalize_smr_series_matches_scalar(app, smr_values):
+    values = pd.Series(smr_values, dtype=object)
+    expected = [app.normalize_smr(v) for v in smr_values]
+    result = app.normalize_smr_series(values)
+    assert result.astype(object).tolist() == expected
+    assert list(result.cat.categories) == app.SMR_ORDER
+
+
+@pytest.mark.parametrize("type_produit", ["medicament", "dispositif_medical"])
+def test_normalize_asmr_asr_frame_matches_scalar(app, asmr_values, type_produit):
+    values = pd.Series(asmr_values, dtype=object)
+    types = pd.Series(type_produit, index=values.index)
+    expected = [app.normalize_asmr_asr(v, type_produit) for v in asmr_values]
+    result = app.normalize_asmr_asr_frame(values, types)
+    rows = list(zip(*(result[c].astype(object) for c in ["_roman", "_label_amr", "_source_amr"])))
+    assert rows == expected
+
+
+def test_normalize_asmr_asr_frame_mixed_types(app, asmr_values):
+    values = pd.Series(asmr_values * 2, dtype=object)
+    types = pd.Series(
+        ["medicament"] * len(asmr_values) + ["dispositif_medical"] * len(asmr_values),
+        dtype="category",
+    )
+    expected = [app.normalize_asmr_asr(v, t) for v, t in zip(values, types)]
+    result = app.normalize_asmr_asr_frame(values, types)
+    rows = list(zip(*(result[c].astype(object) for c in ["_roman", "_label_amr", "_source_amr"])))
+    assert rows == expected
+
+
+def test_arrow_string_input(app, smr_values):
+    values = pd.Series([v for v in smr_values if isinstance(v, str)], dtype="str")
+    expected = [app.normalize_smr(v) for v in values]
+    assert app.normalize_smr_series(values).astype(object).tolist() == expected
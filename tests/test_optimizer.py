@@ -0,0 +1,81 @@
+from itertools import combinations, product
+
+import numpy as np
+import pytest
+
+
+def _matrices(parts):
+    n = len(parts)
+    return {
+        "SMR": {
+            "niveaux": ["Important", "Faible"],
+            "parts":   np.column_stack([parts, 1 - parts]),
+            "present": np.ones(n, dtype=bool),
+        },
+    }
+
+
+def _exact_max(a, poids, lo, hi, rotation_max):
+    """max a·s par énumération des sommets de {lo ≤ s ≤ hi, Σs = 1, ½·Σ|s − poids| ≤ R}."""
+    n = len(a)
+    G = [*np.eye(n), *-np.eye(n)]
+    h = [*hi, *-lo]
+    for signes in product([-1.0, 1.0], repeat=n):
+        sigma = np.array(signes)
+        G.append(sigma)
+        h.append(2 * rotation_max + sigma @ poids)
+    G, h = np.array(G), np.array(h)
+    best = -np.inf
+    for actives in combinations(range(len(G)), n - 1):
+        A = np.vstack([G[list(actives)], np.ones(n)])
+        if abs(np.linalg.det(A)) < 1e-12:
+            continue
+        s = np.linalg.solve(A, np.append(h[list(actives)], 1.0))
+        if (G @ s <= h + 1e-9).all():
+            best = max(best, a @ s)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_linear_objective_matches_exact_solution(app, seed):
+    rng   = np.random.default_rng(seed)
+    n     = int(rng.integers(3, 5))
+    poids = rng.dirichlet(np.ones(n))
+    parts = rng.random(n)
+    lo, hi = np.ones(n), np.zeros(n)
+    while lo.sum() > 1 or hi.sum() < 1:
+        lo = np.where(rng.random(n) < 0.5, rng.uniform(0, 0.4, n), 0.0)
+        hi = np.maximum(lo, np.where(rng.random(n) < 0.5, rng.uniform(0.1, 0.6, n), 1.0))
+    depart = np.clip(poids, lo, hi)
+    rotation_min = (np.abs(poids - depart).sum() + abs(1 - depart.sum())) / 2
+    rotation_max = rotation_min + rng.uniform(0, 0.3)
+
+    res = app.optimize_weights(
+        _matrices(parts), poids, "Maximiser SMR Important", lo, hi, rotation_max,
+    )
+    w = res["poids"]
+    assert w.sum() == pytest.approx(1.0)
+    assert (w >= lo - 1e-9).all() and (w <= hi + 1e-9).all()
+    assert np.abs(w - poids).sum() / 2 <= rotation_max + 1e-9
+    assert res["valeur"] == pytest.approx(
+        100 * _exact_max(parts, poids, lo, hi, rotation_max), abs=1e-6
+    )
+
+
+def test_rotation_measured_from_imported_weights(app):
+    # Les poids importés dépassent le max de la ligne 0 : la rotation reste
+    # mesurée depuis ces poids, pas depuis le point ramené dans les bornes
+    poids = np.array([0.6, 0.3, 0.1])
+    parts = np.array([0.0, 0.2, 1.0])
+    lo, hi = np.zeros(3), np.array([0.4, 1.0, 1.0])
+    res = app.optimize_weights(_matrices(parts), poids, "Maximiser SMR Important", lo, hi, 0.3)
+    np.testing.assert_allclose(res["poids"], [0.3, 0.3, 0.4], atol=1e-9)
+    assert res["rotation"] == pytest.approx(0.3)
+
+
+def test_rotation_too_low_raises(app):
+    with pytest.raises(ValueError, match="Rotation maximale trop faible"):
+        app.optimize_weights(
+            _matrices(np.array([0.1, 0.9])), np.array([0.8, 0.2]),
+            "Maximiser SMR Important", np.zeros(2), np.array([0.5, 1.0]), 0.1,
+        )
@@ -0,0 +1,12 @@
+def test_leading_zeros_kept_in_text_columns(app):
+    raw = "Code dossier\tNom dispositif\n00012\tStent\n00340\tValve\n".encode("latin-1")
+    df = app.parse_export(raw, schema=app.DATASET_SCHEMAS[app.ID_DISPO])
+    assert df["Code dossier"].tolist() == ["00012", "00340"]
+
+
+def test_float_columns_coerced(app):
+    raw = b"Code CIS\tRevenue_USD\n00042\t1.5\n00043\tN/A\n"
+    df = app.parse_export(raw, schema={"Code CIS": "str", "Revenue_USD": "float"})
+    assert df["Code CIS"].tolist() == ["00042", "00043"]
+    assert df["Revenue_USD"].iloc[0] == 1.5
+    assert df["Revenue_USD"].isna().iloc[1]
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+
+
+def _frame(rows):
+    return pd.DataFrame(rows, columns=["Titulaire(s)", "groupe_racine", "type_produit"])
+
+
+@pytest.fixture
+def store(app):
+    store = app.data_store()
+    yield store
+    for key in ("frames", "versions"):
+        store[key].pop("df3_enriched", None)
+    store["indexes"].pop("hierarchy", None)
+    app._run_frames.pop("df3_enriched", None)
+
+
+def test_hierarchy_positions_refer_to_returned_frame(app, store):
+    old = _frame([("A1", "A", "medicament"), ("B1", "B", "medicament"), ("A2", "A", "dispositif_medical")])
+    app._run_frames["df3_enriched"] = old
+    app._install(store, {"df3_enriched": (old, "v1")})
+    frame, hierarchy = app.hierarchy_index()
+    assert frame is old
+
+    # Rafraîchissement concurrent : le store publie un frame réordonné
+    new = _frame([("B1", "B", "medicament"), ("B2", "B", "medicament"), ("A1", "A", "medicament")])
+    app._install(store, {"df3_enriched": (new, "v2")})
+
+    resolved = pd.DataFrame({
+        "label_import": ["groupe A"], "col_filter": ["groupe_racine"],
+        "val_filter": ["A"], "poids_norm": [1.0],
+    })
+    portfolio = app.build_portfolio(hierarchy, resolved)
+    rows = app.portfolio_frame(frame, portfolio, resolved, ["Titulaire(s)", "groupe_racine"])
+    assert rows["groupe_racine"].tolist() == ["A", "A"]
+    assert rows["Titulaire(s)"].tolist() == ["A1", "A2"]
+
+    frame, hierarchy = app.hierarchy_index()
+    assert frame is new
+    assert hierarchy["lignes"]["groupe_racine"]["A"].tolist() == [2]
@@ -0,0 +1,18 @@
+import pandas as pd
+
+
+def _index(app, values):
+    options = pd.Series(values, dtype=object).unique()
+    return app.build_typeahead_index({"df": {"Dénomination du médicament": (options, None)}})
+
+
+def test_total_counts_all_matches_beyond_top_k(app):
+    index = _index(app, [f"Doliprane {i}" for i in range(50)] + ["Efferalgan"])
+    hits, total = app.typeahead_search(index, "dolip", k=5)
+    assert len(hits) == 5
+    assert total == 50
+
+
+def test_no_match(app):
+    hits, total = app.typeahead_search(_index(app, ["Doliprane"]), "xyz")
+    assert hits.empty and total == 0